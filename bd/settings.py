@@ -41,12 +41,14 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE_CLASSES = [
+    'practicas.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.auth.middleware.SessionAuthenticationMiddleware',
+    'practicas.middleware.CurrentRoleMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -82,6 +84,19 @@ DATABASES = {
     }
 }
 
+# The default cache must be shared by every process (e.g. memcached) when there are several: assignment jobs
+# and cache versions live there.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Rendered pages of projects of finished courses, kept across restarts
+    'snapshots': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache', 'snapshots'),
+    },
+}
+
 # # Password validation
 # # https://docs.djangoproject.com/en/1.9/ref/settings/#auth-password-validators
 #
@@ -127,5 +142,24 @@ REGISTRATION_AUTO_LOGIN = True
 LOGIN_REDIRECT_URL = '/index/'
 LOGIN_URL = '/accounts/login/'
 
+# Registered students the project assignment page takes at once, which posts three fields for each
+ASSIGN_MAX_STUDENTS = 10000
+DATA_UPLOAD_MAX_NUMBER_FIELDS = ASSIGN_MAX_STUDENTS * 3 + 10
+
+# Maximum number of queries per request, by URL name, before a warning is logged
+QUERY_BUDGET = 50
+QUERY_BUDGETS = {
+    'index': 9,
+    'projects-available': 10,
+    'projects-assign': 16,
+    'requests-list': 10,
+    'archive-projects': 10,
+    'archive-project-detail': 10,
+}
+# Requests per view kept for the percentiles shown in /metrics/
+METRICS_WINDOW = 1000
+# Count the queries of every request even without DEBUG, at the cost of logging each of them
+METRICS_QUERIES = False
+
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
@@ -0,0 +1,127 @@
+import argparse
+import json
+import os
+import platform
+import time
+import tracemalloc
+from collections import OrderedDict
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bd.settings')
+django.setup()
+
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Count, F, Sum
+from django.test.utils import CaptureQueriesContext
+
+from practicas import courses
+from practicas.assignment import load_problem, save_assignment, solve, statistics
+from practicas.capacity import reconcile
+from practicas.models import Participation, PracticeManager, Request, Requirement
+from populate_practicas import populate_synthetic
+
+
+def capacity_violations():
+    """
+    Students assigned to a project beyond the seats its requirements offer, not counting those whose
+    request was checked by the tutor: they keep their project even if it is full.
+    """
+    capacity = dict(Requirement.objects.values_list('project').annotate(Sum('capacity')))
+    checked = dict(Request.objects.filter(checked=True, reg_student__participation__project=F('project'))
+                   .values_list('project').annotate(Count('id')))
+    assigned = Participation.objects.exclude(project=None).values_list('project').annotate(Count('id'))
+    return sum(max(0, count - checked.get(project_id, 0) - (capacity.get(project_id) or 0))
+               for project_id, count in assigned)
+
+
+def run_case(students, students_per_project, requests, seed):
+    """Generate a practice of the current course, assign it and measure every step."""
+    call_command('flush', interactive=False, verbosity=0)
+    courses.invalidate()
+
+    start = time.perf_counter()
+    populate_synthetic(courses=1, majors=1, students=students, tutors=max(1, students // 50),
+                       projects=max(1, students // students_per_project), requests=requests, seed=seed)
+    generated = time.perf_counter() - start
+    practice = PracticeManager.objects.select_related('practice').get().practice
+
+    # Peak memory is measured on its own run: tracing slows everything down
+    tracemalloc.start()
+    solve(load_problem(practice))
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        problem = load_problem(practice)
+        loaded = time.perf_counter()
+        assignment = solve(problem)
+        solved = time.perf_counter()
+        # Saving takes the seats from the problem's requirements, so the statistics must come first
+        stats = statistics(problem, assignment)
+        saving = time.perf_counter()
+        save_assignment(problem, assignment)
+        saved = time.perf_counter()
+
+    ranked = sum(stats['ranks'].values())
+    return OrderedDict([
+        ('students', students),
+        ('projects', max(1, students // students_per_project)),
+        ('requests', requests),
+        ('seed', seed),
+        ('generate_seconds', generated),
+        ('load_seconds', loaded - start),
+        ('solve_seconds', solved - loaded),
+        ('save_seconds', saved - saving),
+        ('total_seconds', solved - start + saved - saving),
+        ('queries', len(queries)),
+        ('peak_memory_mb', peak_memory / 2 ** 20),
+        ('assigned', stats['assigned']),
+        ('unassigned', len(stats['unassigned'])),
+        ('first_choice_share', stats['ranks'].get(0, 0) / ranked if ranked else None),
+        ('mean_rank', sum(rank * count for rank, count in stats['ranks'].items()) / ranked if ranked else None),
+        ('capacity_violations', capacity_violations()),
+        ('seat_drift', len(reconcile())),
+    ])
+
+
+# Start execution here!
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the automatic project assignment on synthetic practices. '
+                                                 'It runs on a throwaway test database.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 500, 1000, 5000, 10000, 20000],
+                        help='registered students of each practice')
+    parser.add_argument('--students-per-project', type=int, nargs='+', default=[3, 10])
+    parser.add_argument('--requests', type=int, nargs='+', default=[3, 6], help='requests per student')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark_assignment.json', help='JSON report')
+    args = parser.parse_args()
+
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    cases = []
+    try:
+        print('{0:>8} {1:>8} {2:>8} {3:>8} {4:>8} {5:>8} {6:>8} {7:>8} {8:>10} {9:>10}'.format(
+            'students', 'projects', 'requests', 'solve s', 'total s', 'queries', 'peak MB', 'first %', 'unassigned',
+            'violations'))
+        for students in args.sizes:
+            for students_per_project in args.students_per_project:
+                for requests in args.requests:
+                    case = run_case(students, students_per_project, requests, args.seed)
+                    cases.append(case)
+                    print('{students:>8} {projects:>8} {requests:>8} {solve_seconds:>8.2f} {total_seconds:>8.2f} '
+                          '{queries:>8} {peak_memory_mb:>8.1f} {0:>8.1f} {unassigned:>10} '
+                          '{capacity_violations:>10}'.format((case['first_choice_share'] or 0) * 100, **case))
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    report = OrderedDict([
+        ('python', platform.python_version()),
+        ('django', django.get_version()),
+        ('database', connection.vendor),
+        ('cases', cases),
+    ])
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Report written to {0}'.format(args.output))
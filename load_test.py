@@ -0,0 +1,224 @@
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from datetime import date
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bd.settings')
+django.setup()
+
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import Client
+
+from practicas import metrics
+from practicas.courses import get_current_course
+from practicas.models import *
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)] if values else None
+
+
+def scenarios(admin=None):
+    """
+    Users of each role of the current course and the pages each of them visits, as
+    role -> [(user, [(url name, url), ...]), ...].
+    """
+    course = get_current_course()
+    if course is None:
+        raise ValueError('There is no course in progress; generate data with populate_practicas.py --synthetic.')
+    old_project = Project.objects.filter(course__end__lt=date.today()).order_by('-course__end', 'id').first()
+    archive = [('archive-projects', reverse('archive-projects'))]
+    if old_project:
+        archive.append(('archive-project-detail', reverse('archive-project-detail', args=[old_project.slug])))
+
+    result = defaultdict(list)
+    for reg_student in RegisteredStudent.objects.filter(course=course).select_related('student__user') \
+            .order_by('id')[:1000]:
+        project = Project.objects.filter(practices=reg_student.practice_id).only('slug').first()
+        pages = [('index', reverse('index')), ('projects-available', reverse('projects-available'))]
+        if project:
+            pages.append(('project-detail', reverse('project-detail', args=[project.slug])))
+        result['student'].append((reg_student.student.user, pages))
+
+    for manager in PracticeManager.objects.filter(practice__course=course).select_related('user').order_by('id'):
+        pages = [('index', reverse('index')), ('projects-assign', reverse('projects-assign')),
+                 ('requests-list', reverse('requests-list'))] + archive
+        result['manager'].append((manager.user, pages))
+
+    for tutor in Tutor.objects.filter(project__course=course).distinct().select_related('user').order_by('id')[:100]:
+        pages = [('index', reverse('index')),
+                 ('admin:practicas_project_changelist', reverse('admin:practicas_project_changelist'))] + archive
+        result['tutor'].append((tutor.user, pages))
+
+    admin = User.objects.filter(username=admin) if admin else User.objects.filter(is_superuser=True)
+    admin = admin.first()
+    if admin:
+        project = Project.objects.filter(course=course).order_by('id').first()
+        pages = [('admin:' + name, reverse('admin:' + name)) for name in [
+            'practicas_project_changelist', 'practicas_registeredstudent_changelist', 'practicas_student_changelist',
+            'practicas_project_add']]
+        if project:
+            pages.append(('admin:practicas_project_change', reverse('admin:practicas_project_change',
+                                                                    args=[project.pk])))
+        result['admin'].append((admin, pages))
+    return result
+
+
+def run_user(client, pages, iterations, seed, samples, lock):
+    rng = random.Random(seed)
+    try:
+        for i in range(iterations):
+            name, url = rng.choice(pages)
+            start = time.perf_counter()
+            response = client.get(url)
+            if response.streaming:
+                b''.join(response.streaming_content)
+            elapsed = time.perf_counter() - start
+            with lock:
+                samples[name].append((elapsed, response.status_code))
+    finally:
+        connection.close()
+
+
+def run(users, iterations, seed=0, admin=None):
+    """
+    Drive the site with ``users`` (role -> count) concurrent logged-in users, each one fetching
+    ``iterations`` random pages of its role through the WSGI handler. Returns the report.
+    """
+    available = scenarios(admin)
+    threads = []
+    samples = defaultdict(list)
+    lock = threading.Lock()
+    for role, count in users.items():
+        for user, pages in available[role][:count]:
+            # Logged in beforehand: concurrent session writes would lock SQLite
+            client = Client()
+            client.force_login(user)
+            threads.append(threading.Thread(target=run_user, args=(client, pages, iterations, seed + len(threads),
+                                                                   samples, lock)))
+        if len(available[role]) < count:
+            print('Only {0} {1} users available'.format(len(available[role]), role))
+
+    metrics.reset()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    # Queries per request come from the MetricsMiddleware of the same process
+    views = metrics.snapshot()
+    report = OrderedDict()
+    for name in sorted(samples):
+        latencies = [latency for latency, status in samples[name]]
+        report[name] = OrderedDict([
+            ('requests', len(latencies)),
+            ('errors', sum(1 for latency, status in samples[name] if status >= 400)),
+            ('throughput', len(latencies) / elapsed),
+            ('p50', percentile(latencies, 0.5)),
+            ('p95', percentile(latencies, 0.95)),
+            ('p99', percentile(latencies, 0.99)),
+            ('queries', views[name]['queries']['mean'] if name in views else None),
+        ])
+    return OrderedDict([
+        ('users', users),
+        ('iterations', iterations),
+        ('seconds', elapsed),
+        ('throughput', sum(len(values) for values in samples.values()) / elapsed),
+        ('endpoints', report),
+    ])
+
+
+def compare(report, baseline, tolerance):
+    """Endpoints whose p95 latency grew more than ``tolerance`` or that run more queries than in the baseline."""
+    regressions = []
+    for name, current in report['endpoints'].items():
+        previous = baseline['endpoints'].get(name)
+        if not previous:
+            continue
+        if current['p95'] > previous['p95'] * (1 + tolerance):
+            regressions.append('{0}: p95 {1:.1f}ms -> {2:.1f}ms'.format(name, previous['p95'] * 1000,
+                                                                         current['p95'] * 1000))
+        # Means vary a little with the mix of pages visited: only whole extra queries count
+        if previous['queries'] is not None and current['queries'] is not None and \
+                current['queries'] >= previous['queries'] + 1:
+            regressions.append('{0}: {1:.1f} -> {2:.1f} queries'.format(name, previous['queries'],
+                                                                          current['queries']))
+    return regressions
+
+
+def uncounted(report):
+    """Endpoints without queries in the report: every page reads the session, so queries weren't counted."""
+    return [name for name, data in report['endpoints'].items() if not data['queries']]
+
+
+def print_report(report, baseline=None):
+    print('{0:<45} {1:>6} {2:>6} {3:>8} {4:>8} {5:>8} {6:>8} {7:>8}'.format(
+        'endpoint', 'reqs', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'queries'))
+    for name, data in report['endpoints'].items():
+        line = '{0:<45} {1:>6} {2:>6} {3:>8.1f} {4:>8.1f} {5:>8.1f} {6:>8.1f} {7:>8}'.format(
+            name, data['requests'], data['errors'], data['throughput'], data['p50'] * 1000, data['p95'] * 1000,
+            data['p99'] * 1000, '-' if data['queries'] is None else '{0:.1f}'.format(data['queries']))
+        previous = baseline['endpoints'].get(name) if baseline else None
+        if previous:
+            line += '  (p95 {0:+.0%})'.format(data['p95'] / previous['p95'] - 1)
+        print(line)
+    print('{0} requests in {1:.1f}s, {2:.1f} req/s'.format(
+        sum(data['requests'] for data in report['endpoints'].values()), report['seconds'], report['throughput']))
+
+
+# Start execution here!
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the Practicas pages with concurrent users of each role.')
+    parser.add_argument('--students', type=int, default=20, help='concurrent students')
+    parser.add_argument('--managers', type=int, default=2, help='concurrent practice managers')
+    parser.add_argument('--tutors', type=int, default=5, help='concurrent tutors')
+    parser.add_argument('--admins', type=int, default=1, help='concurrent superusers (0 or 1)')
+    parser.add_argument('--admin', help='username of the superuser, the first one by default')
+    parser.add_argument('--iterations', type=int, default=20, help='pages fetched by each user')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', help='JSON report of a previous run to compare with')
+    parser.add_argument('--save', help='write the JSON report of this run to this file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='p95 growth over the baseline reported as a regression')
+    args = parser.parse_args()
+
+    # Requests go through the WSGI handler in this process, as in production, but still counting queries
+    settings.DEBUG = False
+    settings.METRICS_QUERIES = True
+    settings.ALLOWED_HOSTS = list(settings.ALLOWED_HOSTS) + ['testserver']
+
+    users = OrderedDict([('student', args.students), ('manager', args.managers), ('tutor', args.tutors),
+                         ('admin', args.admins)])
+    report = run(users, args.iterations, args.seed, args.admin)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+
+    missing = uncounted(report)
+    if missing:
+        raise SystemExit('No queries counted for ' + ', '.join(missing))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if baseline:
+        regressions = compare(report, baseline, args.tolerance)
+        for regression in regressions:
+            print('Regression: ' + regression)
+        if regressions:
+            raise SystemExit(1)
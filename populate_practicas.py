@@ -1,11 +1,19 @@
+import argparse
 import os
-from datetime import datetime
+import random
+import time
+from collections import OrderedDict, defaultdict
+from datetime import date, datetime, timedelta
 
 import django
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bd.settings')
 django.setup()
 
+from django.contrib.auth.hashers import make_password
+from django.core.files.base import ContentFile
+
+from practicas import roles
 from practicas.models import *
 
 
@@ -274,7 +282,209 @@ def add_practice_manager(user, practice):
     return pm
 
 
+FIRST_NAMES = ['Ana', 'Carlos', 'Laura', 'Miguel', 'Elena', 'José', 'María', 'Luis', 'Carmen', 'Javier',
+               'Lucía', 'Pedro', 'Daniela', 'Alejandro', 'Sofía', 'Raúl', 'Patricia', 'Jorge', 'Claudia', 'Ernesto']
+LAST_NAMES = ['García', 'Rodríguez', 'González', 'Fernández', 'López', 'Martínez', 'Sánchez', 'Pérez', 'Gómez',
+              'Díaz', 'Hernández', 'Álvarez', 'Romero', 'Torres', 'Ramírez', 'Suárez', 'Castro', 'Vera', 'Rojas']
+MAJORS = [('Ciencia de la Computación', 5), ('Matemática', 4), ('Matemática Aplicada', 5), ('Física', 5),
+          ('Química', 5), ('Bioquímica', 5), ('Geografía', 4), ('Meteorología', 5)]
+WORKPLACES = ['MATCOM', 'IMRE', 'CENATAV', 'ICIMAF', 'CITMATEL']
+TOPICS = ['Reconocimiento de patrones', 'Compiladores', 'Sistemas distribuidos', 'Aprendizaje automático',
+          'Optimización combinatoria', 'Criptografía', 'Bases de datos', 'Visión por computadora',
+          'Procesamiento de lenguaje natural', 'Ecuaciones diferenciales', 'Teoría de grafos', 'Estadística']
+DUMMY_REPORT = b'%PDF-1.4\n% Informe de prueba\n%%EOF\n'
+
+
+def populate_synthetic(courses=3, majors=3, students=500, tutors=50, projects=None, requests=3, reports=0.0,
+                       seed=0):
+    """
+    Bulk create a realistic data set: ``courses`` yearly courses ending with the current one, a
+    practice per major and course with ``students`` registered students each, projects with enough
+    seats for all of them, ``requests`` requests per student and, in finished courses, graded
+    participations. The same seed always produces the same data; usernames include it, so several
+    seeds can live in the same database.
+
+    Every user gets the password '1234', hashed only once. Returns model name -> rows created.
+    """
+    if User.objects.filter(username__startswith='tutor{0}_'.format(seed)).exists():
+        raise ValueError('The data of seed {0} was already generated.'.format(seed))
+
+    rng = random.Random(seed)
+    password = make_password('1234')
+    if projects is None:
+        projects = max(1, students * majors // 3)
+    rows = defaultdict(int)
+
+    def create(model, objects):
+        model.objects.bulk_create(objects, batch_size=500)
+        rows[model.__name__] += len(objects)
+
+    def create_users(prefix, count, **kwargs):
+        users = []
+        for i in range(count):
+            users.append(User(username='{0}{1}_{2}'.format(prefix, seed, i), password=password,
+                              first_name=rng.choice(FIRST_NAMES), last_name=rng.choice(LAST_NAMES), **kwargs))
+            users[-1].email = '{0}@example.com'.format(users[-1].username)
+        create(User, users)
+        return list(User.objects.filter(username__startswith='{0}{1}_'.format(prefix, seed)).order_by('id'))
+
+    def grant(users, role):
+        rows[User.user_permissions.through.__name__] += roles.grant(role, users)
+
+    def save_report(instance, field, name_function):
+        name = fs.save(name_function(instance, 'informe.pdf'), ContentFile(DUMMY_REPORT))
+        setattr(instance, field, name)
+
+    major_objects = [Major.objects.get_or_create(name=name, defaults={'years': years})[0]
+                     for name, years in MAJORS[:majors]]
+    workplaces = [Workplace.objects.get_or_create(name=name, defaults={'address': 'La Habana', 'phone': 0})[0]
+                  for name in WORKPLACES]
+
+    tutor_users = create_users('tutor', tutors, is_staff=True)
+    grant(tutor_users, roles.TUTOR)
+    create(Tutor, [Tutor(user=user, workplace=rng.choice(workplaces), job='Profesor',
+                         category=rng.choice(Tutor.CATEGORIES)[0]) for user in tutor_users])
+    tutor_objects = list(Tutor.objects.filter(user__in=tutor_users).order_by('id'))
+
+    # Courses go from September to August; the last one is in progress
+    today = date.today()
+    first_year = (today.year if today.month >= 9 else today.year - 1) - courses + 1
+    course_objects = []
+    for year in range(first_year, first_year + courses):
+        course, created = Course.objects.get_or_create(start=date(year, 9, 1), end=date(year + 1, 8, 31))
+        course_objects.append(course)
+        rows['Course'] += created
+
+    manager_users = create_users('jefe', courses * majors)
+    grant(manager_users, roles.MANAGER)
+    student_users = create_users('estudiante', courses * majors * students)
+    grant(student_users, roles.STUDENT)
+    create(Student, [Student(user=user) for user in student_users])
+    student_objects = list(Student.objects.filter(user__in=student_users).order_by('id'))
+
+    practices = []
+    used_dates = set(Practice.objects.values_list('start', flat=True)) | \
+        set(Practice.objects.values_list('end', flat=True))
+    for course in course_objects:
+        finished = course.end < today
+        course_practices = []
+        for major in major_objects:
+            # Practices start on different days: the database has unique start and end dates
+            start = date(course.end.year, 6, 1)
+            while start in used_dates or start + timedelta(days=21) in used_dates:
+                start += timedelta(days=1)
+            practice, created = Practice.objects.get_or_create(
+                course=course, major=major, year=rng.randint(2, major.years),
+                defaults={'start': start, 'end': start + timedelta(days=21)})
+            used_dates.update([practice.start, practice.end])
+            rows['Practice'] += created
+            course_practices.append(practice)
+            practices.append(practice)
+
+        # Projects are looked up by slug, so names must be unique
+        names = ['{0} {1}-{2}-{3}'.format(rng.choice(TOPICS), seed, course.start.year, i + 1) for i in range(projects)]
+        create(Project, [Project(tutor=rng.choice(tutor_objects), course=course, name=name, slug=slugify(name),
+                                 description='Proyecto de {0}.'.format(name.lower())) for name in names])
+        course_projects = list(Project.objects.filter(course=course).order_by('-id')[:projects])[::-1]
+        if finished and reports:
+            for project in course_projects:
+                if rng.random() < reports:
+                    save_report(project, 'report', make_project_report_name)
+                    project.save(update_fields=['report'])
+
+        # Each project is offered to one or two practices of its course, with a few seats for each
+        through = Project.practices.through
+        offered = defaultdict(list)
+        seats = {}
+        for project in course_projects:
+            for practice in rng.sample(course_practices, 2 if len(course_practices) > 1 and rng.random() < 0.3
+                                       else 1):
+                offered[practice.id].append(project)
+                seats[project.id, practice.id] = rng.randint(2, 6)
+        create(through, [through(project_id=project.id, practice_id=practice_id)
+                         for practice_id, offers in offered.items() for project in offers])
+
+        for practice in course_practices:
+            # Enough seats for everyone, spread over the practice's projects
+            offers = offered[practice.id] or [rng.choice(course_projects)]
+            if not offered[practice.id]:
+                offered[practice.id] = offers
+                seats[offers[0].id, practice.id] = 0
+                create(through, [through(project_id=offers[0].id, practice_id=practice.id)])
+            missing = students - sum(seats[project.id, practice.id] for project in offers)
+            for i in range(max(0, missing)):
+                seats[offers[i % len(offers)].id, practice.id] += 1
+
+            create(PracticeManager, [PracticeManager(user=manager_users[practices.index(practice)], practice=practice)])
+
+            first = practices.index(practice) * students
+            reg_students = [RegisteredStudent(student=student, practice=practice, course=course,
+                                              group='C{0}{1}'.format(practice.year, rng.randint(1, 4)))
+                            for student in student_objects[first:first + students]]
+            create(RegisteredStudent, reg_students)
+            # The practice may be shared with the students of other seeds
+            reg_students = list(RegisteredStudent.objects
+                                .filter(practice=practice, student__user__username__startswith='estudiante{0}_'
+                                        .format(seed))
+                                .select_related('student__user', 'course').order_by('id'))
+
+            request_objects = []
+            participations = []
+            taken = defaultdict(int)
+            for reg_student in reg_students:
+                chosen = rng.sample(offers, min(requests, len(offers)))
+                request_objects.extend(Request(reg_student=reg_student, project=project, priority=priority,
+                                               checked=priority == 0 and rng.random() < 0.1)
+                                       for priority, project in enumerate(chosen))
+                if not finished:
+                    continue
+                # Finished courses were assigned: the best requested project with a free seat
+                free = [project for project in chosen + offers if taken[project.id] < seats[project.id, practice.id]]
+                if free:
+                    taken[free[0].id] += 1
+                    grade = rng.randint(3, 5)
+                    participation = Participation(reg_student=reg_student, project=free[0],
+                                                  proposed_grade=grade, grade=grade)
+                    if rng.random() < reports:
+                        save_report(participation, 'report', make_participation_student_report_name)
+                        save_report(participation, 'tutor_report', make_participation_tutor_report_name)
+                    participations.append(participation)
+            create(Request, request_objects)
+            create(Participation, participations)
+
+            create(Requirement, [Requirement(project=project, major=practice.major, year=practice.year,
+                                             capacity=seats[project.id, practice.id],
+                                             students_count=seats[project.id, practice.id] - taken[project.id])
+                                 for project in offers])
+
+    return OrderedDict(sorted(rows.items()))
+
+
 # Start execution here!
 if __name__ == '__main__':
-    print("Starting Practicas population script...")
-    populate()
+    parser = argparse.ArgumentParser(description='Populate the Practicas database.')
+    parser.add_argument('--synthetic', action='store_true',
+                        help='generate a synthetic data set instead of the sample data')
+    parser.add_argument('--courses', type=int, default=3, help='courses, the last one being the current one')
+    parser.add_argument('--majors', type=int, default=3, help='majors, each with a practice per course')
+    parser.add_argument('--students', type=int, default=500, help='registered students per practice')
+    parser.add_argument('--tutors', type=int, default=50)
+    parser.add_argument('--projects', type=int, help='projects per course (enough seats for every student)')
+    parser.add_argument('--requests', type=int, default=3, help='requests per registered student')
+    parser.add_argument('--reports', type=float, default=0.0,
+                        help='fraction of finished participations and projects with dummy uploaded reports')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.synthetic:
+        print("Generating synthetic Practicas data...")
+        start = time.time()
+        rows = populate_synthetic(courses=args.courses, majors=args.majors, students=args.students,
+                                  tutors=args.tutors, projects=args.projects, requests=args.requests,
+                                  reports=args.reports, seed=args.seed)
+        for model, count in rows.items():
+            print('{0:>25}: {1}'.format(model, count))
+        print('{0} rows in {1:.1f}s'.format(sum(rows.values()), time.time() - start))
+    else:
+        print("Starting Practicas population script...")
+        populate()
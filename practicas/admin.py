@@ -1,17 +1,19 @@
 from datetime import date
 
-from django.contrib import admin
+from django.conf.urls import url
+from django.contrib import admin, messages
 from django.contrib.auth.admin import UserAdmin, GroupAdmin
+from django.contrib.auth.models import Group
+from django.core.exceptions import PermissionDenied
+from django.template.response import TemplateResponse
 
+from .courses import get_current_course, require_current_course
 from .forms import RequestAdminForm, ParticipationAdminForm, RegisteredStudentForm, ProjectForm, \
-    StudentForm, TutorForm, PracticeManagerForm
+    StudentForm, TutorForm, PracticeManagerForm, StudentImportForm, RequirementInlineFormSet, BatchEligibilityFormSet
+from .imports import import_students, read_rows
 from .models import *
 
 
-def get_current_course():
-    return Course.objects.get(start__lte=date.today(), end__gte=date.today())
-
-
 def get_object_course(object_id):
     project = Project.objects.get(id=object_id)
     return project.course
@@ -22,7 +24,12 @@ def get_queryset_with_matching_course(field, db_field, request):
         if request._obj_:
             field.queryset = field.queryset.filter(course=request._obj_.course)
         else:
-            field.queryset = field.queryset.filter(course=get_current_course())
+            course = get_current_course()
+            field.queryset = field.queryset.filter(course=course) if course else field.queryset.none()
+        if db_field.name == 'reg_student':
+            field.queryset = field.queryset.select_related('student__user', 'course')
+        # Every row of the inline shares the same choices, so they are fetched once here
+        field.choices = list(field.choices)
     return field
 
 
@@ -37,12 +44,18 @@ admin.site = AdminSite()
 class RequirementInline(admin.TabularInline):
     model = Requirement
     extra = 1
+    formset = RequirementInlineFormSet
 
 
 class RequestInline(admin.TabularInline):
     model = Request
     extra = 1
     form = RequestAdminForm
+    formset = BatchEligibilityFormSet
+
+    def get_queryset(self, request):
+        return super(RequestInline, self).get_queryset(request) \
+            .select_related('reg_student__student__user', 'reg_student__course', 'project__course')
 
     def formfield_for_foreignkey(self, db_field, request=None, **kwargs):
         field = super(RequestInline, self).formfield_for_foreignkey(db_field, request, **kwargs)
@@ -73,6 +86,11 @@ class ParticipationInline(admin.TabularInline):
     model = Participation
     extra = 1
     form = ParticipationAdminForm
+    formset = BatchEligibilityFormSet
+
+    def get_queryset(self, request):
+        return super(ParticipationInline, self).get_queryset(request) \
+            .select_related('reg_student__student__user', 'reg_student__course', 'project')
 
     def formfield_for_foreignkey(self, db_field, request=None, **kwargs):
         field = super(ParticipationInline, self).formfield_for_foreignkey(db_field, request, **kwargs)
@@ -106,6 +124,7 @@ class WorkplaceAdmin(admin.ModelAdmin):
 
 class CustomUserAdmin(admin.ModelAdmin):
     search_fields = ['user__first_name', 'user__last_name']
+    list_select_related = ['user']
     fieldsets = [
         ('Datos personales', {
             'fields': ('first_name', 'last_name', 'email')
@@ -129,12 +148,49 @@ class RegisteredStudentAdmin(admin.ModelAdmin):
     search_fields = ['student__user__first_name', 'student__user__last_name']
     inlines = [RequestStudentInline, ParticipationInline]
     form = RegisteredStudentForm
+    list_select_related = ['student__user', 'course']
 
     def get_form(self, request, obj=None, **kwargs):
         # just save obj reference for future processing in Inline
         request._obj_ = obj
         return super(RegisteredStudentAdmin, self).get_form(request, obj, **kwargs)
 
+    def formfield_for_foreignkey(self, db_field, request=None, **kwargs):
+        field = super(RegisteredStudentAdmin, self).formfield_for_foreignkey(db_field, request, **kwargs)
+        if db_field.name == 'student':
+            field.queryset = field.queryset.select_related('user')
+        return field
+
+    def get_urls(self):
+        return [url(r'^import/$', self.admin_site.admin_view(self.import_view),
+                    name='practicas_registeredstudent_import')] + super(RegisteredStudentAdmin, self).get_urls()
+
+    def import_view(self, request):
+        if not self.has_add_permission(request):
+            raise PermissionDenied
+
+        result = None
+        if request.method == 'POST':
+            form = StudentImportForm(request.POST, request.FILES)
+            if form.is_valid():
+                upload = form.cleaned_data['file']
+                try:
+                    result = import_students(read_rows(upload, upload.name), form.cleaned_data['course'],
+                                             form.cleaned_data['password'] or None)
+                except ValueError as e:
+                    form.add_error('file', str(e))
+                else:
+                    messages.success(request, '{0} estudiante(s) registrado(s), {1} usuario(s) nuevo(s).'.format(
+                        result.registered, result.users))
+                    if result.errors:
+                        messages.warning(request, '{0} fila(s) con errores.'.format(len(result.errors)))
+        else:
+            form = StudentImportForm()
+
+        context = dict(self.admin_site.each_context(request), opts=self.model._meta, form=form, result=result,
+                       title='Importar estudiantes')
+        return TemplateResponse(request, 'admin/practicas/registeredstudent/import.html', context)
+
 
 @admin.register(Project, site=admin.site)
 class ProjectAdmin(admin.ModelAdmin):
@@ -146,10 +202,16 @@ class ProjectAdmin(admin.ModelAdmin):
     filter_horizontal = ('practices',)
     fields = ['tutor', 'course', 'name', 'description', 'report', 'practices']
 
+    def has_add_permission(self, request):
+        # Tutors' projects go to the current course, so there must be one
+        if not request.user.is_superuser and get_current_course() is None:
+            return False
+        return super(ProjectAdmin, self).has_add_permission(request)
+
     def save_model(self, request, obj, form, change):
         if not request.user.is_superuser:
             obj.tutor = Tutor.objects.get(user=request.user)
-            obj.course = get_current_course()
+            obj.course = (get_current_course() or obj.course) if change else require_current_course()
         super(ProjectAdmin, self).save_model(request, obj, form, change)
 
     def get_form(self, request, obj=None, **kwargs):
@@ -157,6 +219,18 @@ class ProjectAdmin(admin.ModelAdmin):
         request._obj_ = obj
         return super(ProjectAdmin, self).get_form(request, obj, **kwargs)
 
+    def formfield_for_foreignkey(self, db_field, request=None, **kwargs):
+        field = super(ProjectAdmin, self).formfield_for_foreignkey(db_field, request, **kwargs)
+        if db_field.name == 'tutor':
+            field.queryset = field.queryset.select_related('user')
+        return field
+
+    def formfield_for_manytomany(self, db_field, request=None, **kwargs):
+        field = super(ProjectAdmin, self).formfield_for_manytomany(db_field, request, **kwargs)
+        if db_field.name == 'practices':
+            field.queryset = field.queryset.select_related('major', 'course')
+        return field
+
     def get_queryset(self, request):
         qs = super(ProjectAdmin, self).get_queryset(request)
         if request.user.is_superuser:
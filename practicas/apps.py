@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class PracticasConfig(AppConfig):
     name = 'practicas'
+
+    def ready(self):
+        from . import metrics, signals  # noqa
+        metrics.instrument_templates()
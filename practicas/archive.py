@@ -0,0 +1,17 @@
+from django.core.cache import cache
+
+VERSION_KEY = 'practicas:archive:version'
+# Pages of the project archive are kept this long, unless a project, tutor or course changes first
+TIMEOUT = 24 * 60 * 60
+
+
+def version():
+    """Version of the rendered pages of the project archive, part of their fragment cache key."""
+    return cache.get_or_set(VERSION_KEY, 1, None)
+
+
+def invalidate():
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        pass
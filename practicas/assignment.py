@@ -0,0 +1,410 @@
+import copy
+import heapq
+import random
+import threading
+from collections import Counter, defaultdict, deque
+from multiprocessing import Pool
+
+from .models import Participation, RegisteredStudent, Request, Requirement
+
+INFINITY = float('inf')
+
+# Last problem and solution of each practice, kept as warm start for incremental re-assignment. It is only
+# a hint: reassign() always reloads the problem and compares it, so changes made by any process are seen.
+_solutions = {}
+_lock = threading.Lock()
+
+
+class AssignmentProblem(object):
+    """
+    In-memory snapshot of everything needed to assign the projects of a practice:
+    registered students, their current participations, their requests and the
+    remaining seats of every requirement matching the practice's major and year.
+    """
+
+    def __init__(self, practice_id, students, participations, assigned, requests, requirements):
+        self.practice_id = practice_id
+        # Registered students ids, in a stable order
+        self.students = students
+        # reg_student_id -> participation_id of existing participations
+        self.participations = participations
+        # reg_student_id -> project_id of participations that already have a project
+        self.assigned = assigned
+        # reg_student_id -> [(priority, project_id, checked)] sorted by priority
+        self.requests = requests
+        # project_id -> [[requirement_id, year, remaining seats]] sorted by year, highest first
+        self.requirements = requirements
+
+    def copy(self):
+        """Deep copy, so what-if variants (e.g. other seat counts) can be solved without touching this one."""
+        return copy.deepcopy(self)
+
+    def capacity(self, project_id):
+        return sum(req[2] for req in self.requirements.get(project_id, ()))
+
+    def rank(self, reg_student_id, project_id):
+        """
+        Position of the project among the student's choices (0 is the first choice). Requests
+        sharing the same priority share the same rank.
+        """
+        priorities = sorted({priority for priority, _, _ in self.requests.get(reg_student_id, ())})
+        for priority, project, _ in self.requests.get(reg_student_id, ()):
+            if project == project_id:
+                return priorities.index(priority)
+        return None
+
+
+class Assignment(object):
+    """Result of solving an :class:`AssignmentProblem`. Only holds new assignments."""
+
+    def __init__(self, projects, ranks, unassigned):
+        # reg_student_id -> project_id
+        self.projects = projects
+        # reg_student_id -> rank of the assigned project among the student's requests
+        self.ranks = ranks
+        # Students with requests that could not be assigned
+        self.unassigned = unassigned
+
+    @property
+    def cost(self):
+        return sum(self.ranks.values())
+
+
+def load_problem(practice):
+    """Load an :class:`AssignmentProblem` for the given practice in three queries."""
+    students = []
+    participations = {}
+    assigned = {}
+    for rs_id, part_id, project_id in RegisteredStudent.objects.filter(practice=practice) \
+            .order_by('id').values_list('id', 'participation__id', 'participation__project'):
+        students.append(rs_id)
+        if part_id:
+            participations[rs_id] = part_id
+        if project_id:
+            assigned[rs_id] = project_id
+
+    requests = defaultdict(list)
+    for rs_id, project_id, priority, checked in Request.objects \
+            .filter(reg_student__practice=practice, project__practices=practice) \
+            .values_list('reg_student', 'project', 'priority', 'checked'):
+        requests[rs_id].append((priority, project_id, checked))
+    for reqs in requests.values():
+        reqs.sort()
+
+    requirements = defaultdict(list)
+    for req_id, project_id, year, count in Requirement.objects \
+            .filter(project__practices=practice, major=practice.major_id, year__lte=practice.year) \
+            .order_by('-year').values_list('id', 'project', 'year', 'students_count'):
+        requirements[project_id].append([req_id, year, max(count, 0)])
+
+    return AssignmentProblem(practice.id, students, participations, assigned, dict(requests), dict(requirements))
+
+
+class _MinCostFlow(object):
+    """Primal-dual min cost max flow: Dijkstra with potentials plus blocking flows on zero reduced cost edges."""
+
+    def __init__(self, size):
+        self.graph = [[] for _ in range(size)]
+
+    def add_edge(self, u, v, cap, cost):
+        # Edges are [to, capacity, cost, index of reverse edge]
+        self.graph[u].append([v, cap, cost, len(self.graph[v])])
+        self.graph[v].append([u, 0, -cost, len(self.graph[u]) - 1])
+
+    def _shortest_paths(self, source, potential):
+        graph = self.graph
+        dist = [INFINITY] * len(graph)
+        dist[source] = 0
+        heap = [(0, source)]
+        while heap:
+            d, u = heapq.heappop(heap)
+            if d > dist[u]:
+                continue
+            pu = potential[u]
+            for v, cap, cost, _ in graph[u]:
+                if cap > 0:
+                    nd = d + cost + pu - potential[v]
+                    if nd < dist[v]:
+                        dist[v] = nd
+                        heapq.heappush(heap, (nd, v))
+        return dist
+
+    def _levels(self, source, potential):
+        level = [-1] * len(self.graph)
+        level[source] = 0
+        queue = deque([source])
+        while queue:
+            u = queue.popleft()
+            for v, cap, cost, _ in self.graph[u]:
+                if cap > 0 and level[v] < 0 and cost + potential[u] - potential[v] == 0:
+                    level[v] = level[u] + 1
+                    queue.append(v)
+        return level
+
+    def _augment(self, source, sink, potential, level):
+        graph = self.graph
+        pointer = [0] * len(graph)
+        flow = 0
+        while True:
+            # Iterative DFS over the layered admissible graph, pushing one unit per path
+            path = []
+            u = source
+            while u != sink:
+                edges = graph[u]
+                while pointer[u] < len(edges):
+                    v, cap, cost, _ = edges[pointer[u]]
+                    if cap > 0 and level[v] == level[u] + 1 and cost + potential[u] - potential[v] == 0:
+                        break
+                    pointer[u] += 1
+                if pointer[u] < len(edges):
+                    path.append((u, pointer[u]))
+                    u = edges[pointer[u]][0]
+                elif path:
+                    level[u] = -1
+                    u, _ = path.pop()
+                    pointer[u] += 1
+                else:
+                    return flow
+            for u, i in path:
+                edge = graph[u][i]
+                edge[1] -= 1
+                graph[edge[0]][edge[3]][1] += 1
+            flow += 1
+
+    def run(self, source, sink):
+        potential = [0] * len(self.graph)
+        while True:
+            dist = self._shortest_paths(source, potential)
+            if dist[sink] == INFINITY:
+                return
+            for v, d in enumerate(dist):
+                if d < INFINITY:
+                    potential[v] += d
+            while True:
+                level = self._levels(source, potential)
+                if level[sink] < 0 or not self._augment(source, sink, potential, level):
+                    break
+
+
+def solve(problem, seed=None):
+    """
+    Assign projects to every student of the problem without one, maximizing the number of
+    assigned students and then minimizing the sum of the ranks of the assigned requests.
+
+    Requests checked by the tutor are honoured first, even when the project is already full.
+    ``seed`` shuffles the students, which only changes how ties between optimal solutions are broken.
+    """
+    capacity = {project_id: problem.capacity(project_id) for project_id in problem.requirements}
+    projects = {}
+    ranks = {}
+
+    free = []
+    for rs_id in problem.students:
+        if rs_id in problem.assigned or rs_id not in problem.requests:
+            continue
+        checked = [project_id for _, project_id, is_checked in problem.requests[rs_id] if is_checked]
+        if checked:
+            projects[rs_id] = checked[0]
+            ranks[rs_id] = problem.rank(rs_id, checked[0])
+            if capacity.get(checked[0], 0) > 0:
+                capacity[checked[0]] -= 1
+        else:
+            free.append(rs_id)
+    if seed is not None:
+        random.Random(seed).shuffle(free)
+
+    # Nodes: 0 is the source, 1 the sink, then students and projects with free seats
+    project_nodes = {}
+    for project_id in sorted(capacity):
+        if capacity[project_id] > 0:
+            project_nodes[project_id] = 2 + len(free) + len(project_nodes)
+    network = _MinCostFlow(2 + len(free) + len(project_nodes))
+    student_edges = []
+    for i, rs_id in enumerate(free):
+        node = 2 + i
+        network.add_edge(0, node, 1, 0)
+        priorities = sorted({priority for priority, _, _ in problem.requests[rs_id]})
+        edges = []
+        for priority, project_id, _ in problem.requests[rs_id]:
+            if project_id in project_nodes:
+                rank = priorities.index(priority)
+                edges.append((len(network.graph[node]), project_id, rank))
+                network.add_edge(node, project_nodes[project_id], 1, rank)
+        student_edges.append(edges)
+    for project_id, node in project_nodes.items():
+        network.add_edge(node, 1, capacity[project_id], 0)
+
+    network.run(0, 1)
+
+    unassigned = []
+    for i, rs_id in enumerate(free):
+        node = 2 + i
+        for index, project_id, rank in student_edges[i]:
+            if network.graph[node][index][1] == 0:
+                projects[rs_id] = project_id
+                ranks[rs_id] = rank
+                break
+        else:
+            unassigned.append(rs_id)
+
+    return Assignment(projects, ranks, sorted(unassigned))
+
+
+def _consume_seats(requirements, assignment):
+    """
+    Drain the given requirements with the new assignment, as ``Participation.save`` does:
+    each student takes a seat from the highest year requirement that still has one.
+    Returns requirement_id -> seats taken.
+    """
+    taken = defaultdict(int)
+    for rs_id in sorted(assignment.projects):
+        for requirement in requirements.get(assignment.projects[rs_id], ()):
+            if requirement[2] > 0:
+                requirement[2] -= 1
+                taken[requirement[0]] += 1
+                break
+    return taken
+
+
+def save_assignment(problem, assignment):
+    """Write the new assignment back to the database in a single transaction."""
+    Participation.objects.bulk_assign(assignment.projects)
+    _consume_seats(problem.requirements, assignment)
+    for rs_id, project_id in assignment.projects.items():
+        problem.assigned[rs_id] = project_id
+    remember(problem, Assignment({}, {}, list(assignment.unassigned)))
+
+
+def statistics(problem, assignment):
+    """Aggregate outcome of an assignment, computed without touching the problem or the database."""
+    requirements = copy.deepcopy(problem.requirements)
+    _consume_seats(requirements, assignment)
+    return {
+        'assigned': len(assignment.projects),
+        'unassigned': list(assignment.unassigned),
+        'cost': assignment.cost,
+        # rank -> number of students that got their (rank + 1)-th choice
+        'ranks': dict(Counter(assignment.ranks.values())),
+        # requirement_id -> seats left empty
+        'under_filled': {req[0]: req[2] for reqs in requirements.values() for req in reqs if req[2] > 0},
+    }
+
+
+class Simulation(object):
+    def __init__(self, seed, assignment, statistics):
+        self.seed = seed
+        self.assignment = assignment
+        self.statistics = statistics
+
+
+def _simulate(args):
+    problem, seed = args
+    assignment = solve(problem, seed)
+    return Simulation(seed, assignment, statistics(problem, assignment))
+
+
+def simulate(problem, seeds, processes=None):
+    """
+    Solve the problem once per seed, in parallel across ``processes`` worker processes (all cores by
+    default), without writing anything. Returns the simulations sorted from best to worst: most assigned
+    students first, then lowest total rank. Any of them may later be passed to :func:`save_assignment`.
+    """
+    seeds = list(seeds)
+    if processes == 1 or len(seeds) < 2:
+        simulations = [_simulate((problem, seed)) for seed in seeds]
+    else:
+        with Pool(processes) as pool:
+            simulations = pool.map(_simulate, [(problem, seed) for seed in seeds])
+    return sorted(simulations, key=lambda sim: (-sim.statistics['assigned'], sim.statistics['cost'], sim.seed))
+
+
+def remember(problem, assignment):
+    """Keep the solution of a practice as warm start for :func:`reassign`."""
+    with _lock:
+        _solutions[problem.practice_id] = (problem, assignment)
+
+
+def _changes(old, new):
+    """Registered students and projects whose data differs between two problems of the same practice."""
+    students = set(old.students) ^ set(new.students)
+    for rs_id in set(old.students) & set(new.students):
+        if old.requests.get(rs_id) != new.requests.get(rs_id) or \
+                old.participations.get(rs_id) != new.participations.get(rs_id) or \
+                old.assigned.get(rs_id) != new.assigned.get(rs_id):
+            students.add(rs_id)
+    projects = {project_id for project_id in set(old.requirements) | set(new.requirements)
+                if old.requirements.get(project_id) != new.requirements.get(project_id)}
+    return students, projects
+
+
+def _affected(problem, assignment, students, projects):
+    """
+    Students whose assignment must be recomputed: the changed ones, those evicted from projects that lost
+    seats, and those that could move into a changed project, because they are unassigned or it is a better
+    choice for them. This is a local repair; a full :func:`solve` is needed for a guaranteed optimum.
+    """
+    members = set(problem.students)
+    affected = {rs_id for rs_id in students if rs_id in members}
+    touched = set(projects)
+    touched.update(assignment.projects[rs_id] for rs_id in students if rs_id in assignment.projects)
+
+    load = defaultdict(list)
+    for rs_id, project_id in assignment.projects.items():
+        if rs_id not in affected and project_id in touched:
+            load[project_id].append(rs_id)
+    for project_id, assigned in load.items():
+        over = len(assigned) - problem.capacity(project_id)
+        if over > 0:
+            evictable = [rs_id for rs_id in assigned
+                         if not any(checked for _, _, checked in problem.requests.get(rs_id, ()))]
+            evictable.sort(key=lambda rs_id: assignment.ranks[rs_id], reverse=True)
+            affected.update(evictable[:over])
+
+    for rs_id, requests in problem.requests.items():
+        if rs_id in affected or rs_id in problem.assigned or rs_id not in members:
+            continue
+        current = assignment.ranks.get(rs_id)
+        for _, project_id, _ in requests:
+            if project_id in touched:
+                rank = problem.rank(rs_id, project_id)
+                if current is None or rank < current:
+                    affected.add(rs_id)
+                    break
+    return affected
+
+
+def reassign(practice):
+    """
+    Incremental version of :func:`solve` for the practice. The problem is always loaded again, and
+    compared with the remembered one to only recompute the students and projects changed since then,
+    whoever changed them. Without a previous solution it falls back to a full solve.
+    Returns the problem and the assignment, which is remembered too.
+    """
+    problem = load_problem(practice)
+    with _lock:
+        state = _solutions.get(practice.id)
+
+    if state is None:
+        assignment = solve(problem)
+        remember(problem, assignment)
+        return problem, assignment
+
+    old, previous = state
+    students, projects = _changes(old, problem)
+    affected = _affected(problem, previous, students, projects)
+
+    # Drop recomputed students, withdrawn students and those assigned meanwhile
+    members = set(problem.students) - affected - set(problem.assigned)
+    kept = Assignment({rs_id: project_id for rs_id, project_id in previous.projects.items() if rs_id in members},
+                      {rs_id: rank for rs_id, rank in previous.ranks.items() if rs_id in members},
+                      [rs_id for rs_id in previous.unassigned if rs_id in members])
+    requirements = copy.deepcopy(problem.requirements)
+    _consume_seats(requirements, kept)
+    partial = solve(AssignmentProblem(problem.practice_id, [rs_id for rs_id in problem.students if rs_id in affected],
+                                      problem.participations, problem.assigned, problem.requests, requirements))
+
+    kept.projects.update(partial.projects)
+    kept.ranks.update(partial.ranks)
+    kept.unassigned = sorted(set(kept.unassigned) | set(partial.unassigned))
+    remember(problem, kept)
+    return problem, kept
@@ -0,0 +1,178 @@
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.db.models import Count, F, Sum
+
+from .models import Participation, Requirement, seats_changed
+
+CACHE_KEY = 'practicas:capacity:{0}'
+
+
+def invalidate(project_ids):
+    cache.delete_many([CACHE_KEY.format(project_id) for project_id in project_ids])
+
+
+def notify(project_ids):
+    """Drop the cached seats of the projects and tell the other caches showing them that they changed."""
+    project_ids = list(project_ids)
+    if project_ids:
+        invalidate(project_ids)
+        seats_changed.send(sender=Requirement, projects=project_ids)
+
+
+def _eligible(project_id, major_id, year):
+    return Requirement.objects.filter(project=project_id, major=major_id, year__lte=year).order_by('-year')
+
+
+def take_seat(project_id, major_id, year):
+    """
+    Atomically take a seat from the highest year requirement of the project that still has one for
+    students of the given major and year. Returns whether a seat was taken: full projects are still
+    assignable (e.g. checked requests), they just don't go below zero.
+    """
+    free = _eligible(project_id, major_id, year).filter(students_count__gt=0)
+    for _ in range(3):
+        # The condition is checked again by the UPDATE itself, so concurrent writers never take the same seat
+        if Requirement.objects.filter(pk__in=free.values('pk')[:1], students_count__gt=0) \
+                .update(students_count=F('students_count') - 1):
+            notify([project_id])
+            return True
+        if not free.exists():
+            break
+    return False
+
+
+def release_seat(project_id, major_id, year):
+    """
+    Atomically give a seat back to the highest year requirement of the project that is missing one,
+    once a student left it. Nothing is given back while the project still holds as many students of
+    the major as seats of the major taken: the student was beyond the capacity and took no seat.
+    Other majors are left out, as their students can't take these seats.
+    """
+    taken = Requirement.objects.filter(project=project_id, major=major_id, capacity__isnull=False) \
+        .aggregate(taken=Sum(F('capacity') - F('students_count')))['taken']
+    if taken is not None and Participation.objects.filter(
+            project=project_id, reg_student__practice__major=major_id).count() >= taken:
+        return
+    eligible = _eligible(project_id, major_id, year)
+    if not Requirement.objects.filter(pk__in=eligible.filter(students_count__lt=F('capacity')).values('pk')[:1]) \
+            .update(students_count=F('students_count') + 1):
+        Requirement.objects.filter(pk__in=eligible.values('pk')[:1]).update(students_count=F('students_count') + 1)
+    notify([project_id])
+
+
+def remaining_seats(project_id, major_id, year):
+    """Remaining seats of the project for students of the given major and year, cached per project."""
+    key = CACHE_KEY.format(project_id)
+    requirements = cache.get(key)
+    if requirements is None:
+        requirements = list(Requirement.objects.filter(project=project_id)
+                            .values_list('major', 'year', 'students_count'))
+        cache.set(key, requirements)
+    return sum(max(count, 0) for major, req_year, count in requirements if major == major_id and req_year <= year)
+
+
+def seats_taken(requirements, participations):
+    """
+    Attribute participations to requirements the way seats are taken: each one from the highest year
+    requirement with a free seat. Participations beyond the capacity (checked requests) take no seat.
+
+    ``requirements`` are (id, project_id, major_id, year, capacity) tuples, a ``None`` capacity being
+    unlimited, and ``participations`` are (project_id, major_id, year, count) tuples.
+    Returns requirement_id -> seats taken.
+    """
+    candidates = defaultdict(list)
+    for req_id, project_id, major_id, year, capacity in requirements:
+        candidates[project_id, major_id].append((year, req_id, capacity))
+    for reqs in candidates.values():
+        reqs.sort(reverse=True)
+
+    taken = defaultdict(int)
+    # The most constrained students, those of lower years, are attributed first
+    for project_id, major_id, year, count in sorted(participations, key=lambda part: part[2]):
+        for req_year, req_id, capacity in candidates[project_id, major_id]:
+            if req_year > year:
+                continue
+            seats = count if capacity is None else min(count, capacity - taken[req_id])
+            taken[req_id] += seats
+            count -= seats
+            if not count:
+                break
+    return taken
+
+
+def participation_counts(participations):
+    """(project_id, major_id, year, count) tuples for the given participations queryset."""
+    return [(part['project'], part['reg_student__practice__major'], part['reg_student__practice__year'], part['count'])
+            for part in participations.exclude(project=None)
+            .values('project', 'reg_student__practice__major', 'reg_student__practice__year')
+            .annotate(count=Count('pk')).order_by()]
+
+
+def reconcile(fix=False):
+    """
+    Recompute the remaining seats of every requirement from its capacity and the existing participations.
+    Returns the drifted requirements as (requirement_id, stored, expected) tuples, fixing them if asked.
+    """
+    requirements = list(Requirement.objects.values_list('id', 'project', 'major', 'year', 'capacity',
+                                                        'students_count'))
+    taken = seats_taken([req[:5] for req in requirements], participation_counts(Participation.objects.all()))
+
+    drift = []
+    fixed = set()
+    for req_id, project_id, _, _, capacity, stored in requirements:
+        expected = capacity - taken[req_id]
+        if stored != expected:
+            drift.append((req_id, stored, expected))
+            if fix:
+                Requirement.objects.filter(pk=req_id).update(students_count=expected)
+                fixed.add(project_id)
+    notify(fixed)
+    return drift
+
+
+def plan_seats(requirements, moves, participants=None):
+    """
+    Compute in memory the seats taken and released by a batch of participation changes, with the same
+    rules as :func:`take_seat` and :func:`release_seat`.
+
+    ``requirements`` are (id, project_id, major_id, year, students_count, capacity) tuples and ``moves``
+    are (old_project_id, new_project_id, major_id, year) tuples, either project being possibly ``None``.
+    ``participants`` maps (project_id, major_id) to the number of participations before the batch; when
+    given, students leaving a project beyond the capacity for their major give no seat back.
+    Returns requirement_id -> change of students_count.
+    """
+    candidates = defaultdict(list)
+    counts = {}
+    capacities = {}
+    taken = defaultdict(int)
+    for req_id, project_id, major_id, year, students_count, capacity in requirements:
+        candidates[project_id, major_id].append((year, req_id))
+        counts[req_id] = students_count
+        capacities[req_id] = capacity
+        if capacity is not None:
+            taken[project_id, major_id] += capacity - students_count
+    for reqs in candidates.values():
+        reqs.sort(reverse=True)
+    occupants = defaultdict(int, participants or {})
+
+    delta = defaultdict(int)
+    for old_project_id, new_project_id, major_id, year in moves:
+        if new_project_id:
+            occupants[new_project_id, major_id] += 1
+            for req_year, req_id in candidates[new_project_id, major_id]:
+                if req_year <= year and counts[req_id] + delta[req_id] > 0:
+                    delta[req_id] -= 1
+                    taken[new_project_id, major_id] += 1
+                    break
+        if old_project_id:
+            occupants[old_project_id, major_id] -= 1
+            if participants is not None and occupants[old_project_id, major_id] >= taken[old_project_id, major_id]:
+                continue
+            eligible = [req_id for req_year, req_id in candidates[old_project_id, major_id] if req_year <= year]
+            missing = [req_id for req_id in eligible if capacities[req_id] is not None and
+                       counts[req_id] + delta[req_id] < capacities[req_id]]
+            if missing or eligible:
+                delta[(missing or eligible)[0]] += 1
+                taken[old_project_id, major_id] -= 1
+    return {req_id: change for req_id, change in delta.items() if change}
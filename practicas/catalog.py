@@ -0,0 +1,38 @@
+import random
+
+from django.core.cache import cache
+
+from .models import Project
+
+VERSION_KEY = 'practicas:catalog:course:{0}'
+CACHE_KEY = 'practicas:catalog:{0}:{1}'
+TIMEOUT = 60 * 60
+
+
+def available_projects(practice):
+    """
+    Summaries (id, slug, name, description) of the projects students of the practice may request,
+    cached once per practice and shared by all of its students, until a project of its course changes.
+    """
+    key = CACHE_KEY.format(cache.get_or_set(VERSION_KEY.format(practice.course_id), 1, None), practice.pk)
+    projects = cache.get(key)
+    if projects is None:
+        projects = list(Project.objects.filter(practices=practice, requirement__major=practice.major_id,
+                                               requirement__year__lte=practice.year)
+                        .distinct().order_by('name').values('id', 'slug', 'name', 'description'))
+        cache.set(key, projects, TIMEOUT)
+    return projects
+
+
+def sample_projects(practice, count):
+    projects = available_projects(practice)
+    return random.sample(projects, min(count, len(projects)))
+
+
+def invalidate(courses):
+    """Drop the catalogs of the practices of the given courses."""
+    for course_id in courses:
+        try:
+            cache.incr(VERSION_KEY.format(course_id))
+        except ValueError:
+            pass
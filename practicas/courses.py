@@ -0,0 +1,36 @@
+import threading
+from datetime import date
+
+from .models import Course
+
+_current = {}
+_lock = threading.Lock()
+
+
+def get_current_course():
+    """
+    Course in progress today, or None. Memoized for the whole process by date, so it is only queried
+    once a day or after a course is saved or deleted.
+    """
+    today = date.today()
+    try:
+        return _current[today]
+    except KeyError:
+        course = Course.objects.filter(start__lte=today, end__gte=today).first()
+        with _lock:
+            _current.clear()
+            _current[today] = course
+        return course
+
+
+def require_current_course():
+    """Course in progress today, for writes that must not go on without one."""
+    course = get_current_course()
+    if course is None:
+        raise Course.DoesNotExist('No hay ningún curso en curso.')
+    return course
+
+
+def invalidate():
+    with _lock:
+        _current.clear()
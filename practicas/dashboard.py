@@ -0,0 +1,97 @@
+from datetime import date
+
+from django.core.cache import cache
+from django.db.models import Case, Count, Sum, Value, When
+from django.db.models.functions import Greatest
+
+from .courses import get_current_course
+from .models import Participation, Project
+
+# Versions of the projects and practices of a course, of the requests, participations and seats of
+# a course (only shown to managers) and of the participation of a registered student
+COURSE_KEY = 'practicas:dashboard:course:{0}'
+ACTIVITY_KEY = 'practicas:dashboard:activity:{0}'
+STUDENT_KEY = 'practicas:dashboard:student:{0}'
+CACHE_KEY = 'practicas:dashboard:{0}:{1}:{2}:{3}:{4}'
+TIMEOUT = 60 * 60
+
+
+def manager_projects(practice):
+    """Projects of the practice with its requests, assigned students and free seats, in a single query."""
+    # Requirements, requests and participations are all joined, so every seat is summed once per
+    # request and participation of the project (or once if there are none): the sum is divided back
+    rows = Greatest(Count('request', distinct=True), Value(1)) * \
+        Greatest(Count('participation', distinct=True), Value(1))
+    return list(Project.objects.filter(practices=practice).order_by('name').annotate(
+        requested=Count(Case(When(request__reg_student__practice=practice, then='request')), distinct=True),
+        assigned=Count(Case(When(participation__reg_student__practice=practice, then='participation')),
+                       distinct=True),
+        students_count=Sum('requirement__students_count') / rows))
+
+
+def _build(user, role):
+    today = date.today()
+    dashboard = {'manager_projects': None, 'grade': None}
+
+    if role.reg_student:
+        dashboard['grade'] = Participation.objects.filter(reg_student=role.reg_student) \
+            .values_list('grade', flat=True).first()
+    if role.manager:
+        dashboard['manager_projects'] = manager_projects(role.manager.practice)
+
+    dashboard['tutor_projects'] = list(Project.objects.filter(tutor__user=user, practices__start__lte=today,
+                                                              practices__end__gte=today).distinct())
+    return dashboard
+
+
+def _version(key):
+    return cache.get_or_set(key, 1, None)
+
+
+def get_dashboard(user, role):
+    """
+    Data shown on the home page for the user and its current role, cached per user, role and current
+    course. Only the versions of what the dashboard shows are part of the key, so a write only drops
+    the dashboards it may change.
+    """
+    course = get_current_course()
+    versions = []
+    if course:
+        versions.append(_version(COURSE_KEY.format(course.pk)))
+        if role.manager:
+            versions.append(_version(ACTIVITY_KEY.format(course.pk)))
+    if role.reg_student:
+        versions.append(_version(STUDENT_KEY.format(role.reg_student.pk)))
+    key = CACHE_KEY.format(user.pk, role.reg_student.pk if role.reg_student else None,
+                           role.manager.pk if role.manager else None, course.pk if course else None,
+                           '-'.join(str(version) for version in versions))
+
+    dashboard = cache.get(key)
+    if dashboard is None:
+        dashboard = _build(user, role)
+        cache.set(key, dashboard, TIMEOUT)
+    return dashboard
+
+
+def _incr(keys):
+    for key in keys:
+        try:
+            cache.incr(key)
+        except ValueError:
+            # No version stored yet, so nothing is cached either
+            pass
+
+
+def invalidate(courses=(), students=()):
+    """Drop the dashboards showing the projects and practices of the courses, or the given registered students."""
+    _incr([COURSE_KEY.format(pk) for pk in courses if pk] + [STUDENT_KEY.format(pk) for pk in students])
+
+
+def invalidate_activity(students=()):
+    """
+    Drop the dashboards showing requests, participations or seats: those of managers of the current
+    course, the only one with cached dashboards, and those of the given registered students.
+    """
+    course = get_current_course()
+    _incr([ACTIVITY_KEY.format(course.pk)] if course else [])
+    invalidate(students=students)
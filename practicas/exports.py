@@ -0,0 +1,85 @@
+import json
+import uuid
+from collections import OrderedDict
+
+from django.db import connections, transaction
+
+PARTICIPATION_COLUMNS = [
+    ('username', 'Usuario'),
+    ('first_name', 'Nombre'),
+    ('last_name', 'Apellidos'),
+    ('course', 'Curso'),
+    ('major', 'Carrera'),
+    ('year', 'Año'),
+    ('group', 'Grupo'),
+    ('project', 'Proyecto'),
+    ('tutor', 'Tutor'),
+    ('proposed_grade', 'Calificación propuesta'),
+    ('grade', 'Calificación'),
+    ('report', 'Informe'),
+    ('tutor_report', 'Informe del tutor'),
+]
+
+
+def _fetch(cursor, size):
+    rows = cursor.fetchmany(size)
+    while rows:
+        for row in rows:
+            yield row
+        rows = cursor.fetchmany(size)
+
+
+def stream_rows(queryset, size=2000):
+    """
+    Rows of a ``values_list()`` queryset, fetched ``size`` at a time from a single query. Unlike
+    ``iterator()``, SQLite doesn't fetch every row at once and PostgreSQL keeps them in a server-side
+    cursor, so memory stays constant however many rows there are. Field converters are not applied.
+    """
+    sql, params = queryset.query.sql_with_params()
+    connection = connections[queryset.db]
+    connection.ensure_connection()
+    if connection.vendor == 'postgresql':
+        # Server-side cursors only live inside a transaction
+        name = 'stream_{0}'.format(uuid.uuid4().hex)
+        with transaction.atomic(using=queryset.db), connection.cursor() as cursor:
+            cursor.execute('DECLARE {0} NO SCROLL CURSOR FOR {1}'.format(name, sql), params)
+            while True:
+                cursor.execute('FETCH {0} FROM {1}'.format(size, name))
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+    else:
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            for row in _fetch(cursor, size):
+                yield row
+
+
+def participation_rows(participations):
+    """
+    Participations as ordered dicts of the export columns, from a single joined query streamed by
+    :func:`stream_rows`, so the rows are never all in memory.
+    """
+    rows = stream_rows(participations.order_by('reg_student__practice', 'reg_student__group',
+                                               'reg_student__student__user__last_name', 'id').values_list(
+        'reg_student__student__user__username', 'reg_student__student__user__first_name',
+        'reg_student__student__user__last_name', 'reg_student__course__start', 'reg_student__course__end',
+        'reg_student__practice__major__name', 'reg_student__practice__year', 'reg_student__group', 'project__name',
+        'project__tutor__user__first_name', 'project__tutor__user__last_name', 'proposed_grade', 'grade', 'report',
+        'tutor_report'))
+    for (username, first_name, last_name, start, end, major, year, group, project, tutor_first_name,
+         tutor_last_name, proposed_grade, grade, report, tutor_report) in rows:
+        tutor = '{0} {1}'.format(tutor_first_name, tutor_last_name) if project is not None else None
+        yield OrderedDict(zip([name for name, _ in PARTICIPATION_COLUMNS], [
+            username, first_name, last_name, '{0}-{1}'.format(start.year, end.year), major, year, group, project,
+            tutor, proposed_grade, grade, bool(report), bool(tutor_report)]))
+
+
+def json_lines(rows):
+    """A JSON array written one element at a time."""
+    yield '['
+    for i, row in enumerate(rows):
+        yield (',\n' if i else '\n') + json.dumps(row, ensure_ascii=False)
+    yield '\n]\n'
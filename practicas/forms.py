@@ -1,8 +1,13 @@
 from datetime import date
 
 from django import forms
+from django.conf import settings
 from django.db import IntegrityError
+from django.utils.encoding import force_text
+from django.utils.html import format_html
+from django.utils.safestring import mark_safe
 
+from .courses import get_current_course
 from .models import *
 
 
@@ -83,20 +88,111 @@ class PracticeManagerForm(forms.ModelForm):
         self.fields['user'].queryset = User.objects.exclude(user_permissions__codename__exact='student_permissions')
 
         if not instance:
-            self.fields['practice'].queryset = Practice.objects.filter(course__start__lte=date.today(),
-                                                                       course__end__gte=date.today())
+            course = get_current_course()
+            self.fields['practice'].queryset = Practice.objects.filter(course=course) if course \
+                else Practice.objects.none()
 
     class Meta:
         model = PracticeManager
         exclude = ()
 
 
+class BatchEligibilityFormSet(forms.BaseInlineFormSet):
+    """
+    Checks that the student of every form can take its project with a single query, instead of the
+    one per form of the model's clean().
+    """
+
+    def _construct_form(self, i, **kwargs):
+        form = super(BatchEligibilityFormSet, self)._construct_form(i, **kwargs)
+        form.instance._eligibility_checked = True
+        return form
+
+    def clean(self):
+        super(BatchEligibilityFormSet, self).clean()
+        forms = [form for form in self.forms if form.is_valid() and not self._should_delete_form(form) and
+                 form.instance.reg_student_id is not None and form.instance.project_id is not None]
+        ineligible = ineligible_pairs((form.instance.reg_student_id, form.instance.project_id) for form in forms)
+        for form in forms:
+            if (form.instance.reg_student_id, form.instance.project_id) in ineligible:
+                form.add_error(None, INELIGIBLE_MESSAGE)
+
+
+class RequirementInlineFormSet(forms.BaseInlineFormSet):
+    """Deletes the requirements marked for deletion all at once, so the requests are pruned only once."""
+
+    def save_existing_objects(self, commit=True):
+        self._deleted_pks = []
+        objects = super(RequirementInlineFormSet, self).save_existing_objects(commit)
+        if self._deleted_pks:
+            Requirement.objects.filter(pk__in=self._deleted_pks).delete()
+        return objects
+
+    def delete_existing(self, obj, commit=True):
+        if commit:
+            self._deleted_pks.append(obj.pk)
+
+
 class RequestAdminForm(forms.ModelForm):
     class Meta:
         model = Request
         exclude = ()
 
 
+class RequestFilterForm(forms.Form):
+    group = forms.CharField(label='Grupo', required=False)
+    project = forms.TypedChoiceField(label='Proyecto', coerce=int, empty_value=None, required=False)
+    checked = forms.NullBooleanField(label='Confirmada', required=False)
+
+    def __init__(self, *args, **kwargs):
+        practice = kwargs.pop('practice')
+        super(RequestFilterForm, self).__init__(*args, **kwargs)
+        self.fields['project'].choices = [('', '---------')] + list(
+            Project.objects.filter(practices=practice).order_by('name').values_list('id', 'name'))
+
+    def filter(self, queryset):
+        if not self.is_valid():
+            return queryset
+        if self.cleaned_data['group']:
+            queryset = queryset.filter(reg_student__group=self.cleaned_data['group'])
+        if self.cleaned_data['project']:
+            queryset = queryset.filter(project=self.cleaned_data['project'])
+        if self.cleaned_data['checked'] is not None:
+            queryset = queryset.filter(checked=self.cleaned_data['checked'])
+        return queryset
+
+
+class ProjectArchiveFilterForm(forms.Form):
+    course = forms.ModelChoiceField(Course.objects.order_by('-start'), label='Curso', required=False)
+    tutor = forms.ModelChoiceField(Tutor.objects.select_related('user').order_by('user__last_name'), label='Tutor',
+                                   required=False)
+    major = forms.ModelChoiceField(Major.objects.order_by('name'), label='Carrera', required=False)
+
+    def filter(self, queryset):
+        if not self.is_valid():
+            return queryset
+        if self.cleaned_data['course']:
+            queryset = queryset.filter(course=self.cleaned_data['course'])
+        if self.cleaned_data['tutor']:
+            queryset = queryset.filter(tutor=self.cleaned_data['tutor'])
+        if self.cleaned_data['major']:
+            queryset = queryset.filter(practices__major=self.cleaned_data['major']).distinct()
+        return queryset
+
+
+class ParticipationExportForm(forms.Form):
+    format = forms.ChoiceField(choices=[('csv', 'CSV'), ('json', 'JSON')], required=False)
+    course = forms.ModelChoiceField(Course.objects.all(), required=False)
+    practice = forms.ModelChoiceField(Practice.objects.all(), required=False)
+
+    def filter(self, queryset):
+        """Participations of the chosen practice or course, of the current course by default."""
+        if self.cleaned_data['practice']:
+            return queryset.filter(reg_student__practice=self.cleaned_data['practice'])
+        course = self.cleaned_data['course'] or get_current_course()
+        return queryset.filter(reg_student__course=course) if course else queryset.none()
+
+
 class RequestForm(forms.ModelForm):
     priority = forms.IntegerField(label='Prioridad', help_text='Por favor asigne una prioridad a su solicitud.',
                                   initial=1)
@@ -106,20 +202,75 @@ class RequestForm(forms.ModelForm):
         fields = ('priority',)
 
 
+class PrerenderedSelect(forms.Select):
+    """Select whose options are rendered once and shared by every form of a formset."""
+
+    def __init__(self, attrs=None, choices=()):
+        super(PrerenderedSelect, self).__init__(attrs, choices)
+        self._options = [(force_text(value), format_html('<option value="{}"', value),
+                          format_html('>{}</option>', label)) for value, label in self.choices]
+
+    def render_options(self, selected_choices):
+        selected_choices = set(force_text(v) for v in selected_choices)
+        return mark_safe('\n'.join(start + (' selected="selected"' if value in selected_choices else '') + end
+                                    for value, start, end in self._options))
+
+
 class ParticipationAssignForm(forms.ModelForm):
+    project = forms.TypedChoiceField(label='Proyecto', coerce=int, empty_value=None, required=False)
     grade = forms.IntegerField(max_value=5, min_value=2, required=False)
 
     def __init__(self, *args, **kwargs):
-        practice = kwargs.pop('practice') if 'practice' in kwargs else None
+        project_widget = kwargs.pop('project_widget')
         super(ParticipationAssignForm, self).__init__(*args, **kwargs)
-        if practice:
-            self.fields['project'] = forms.ModelChoiceField(queryset=Project.objects.filter(practices=practice))
-        if 'instance' in kwargs:
-            self.fields['project'].initial = kwargs['instance'].project
+        self.fields['project'].widget = project_widget
+        self.fields['project'].choices = project_widget.choices
+
+        try:
+            participation = self.instance.participation
+        except Participation.DoesNotExist:
+            participation = None
+        self.proposed_grade = participation.proposed_grade if participation else None
+        if participation:
+            self.initial.setdefault('project', participation.project_id)
+            self.initial.setdefault('grade', participation.grade)
 
     class Meta:
-        model = Participation
-        exclude = ('reg_student',)
+        model = RegisteredStudent
+        fields = ()
+
+
+class BaseParticipationAssignFormSet(forms.BaseModelFormSet):
+    def __init__(self, *args, **kwargs):
+        projects = kwargs.pop('projects')
+        choices = [('', '---------')] + [(project.id, project.name) for project in projects]
+        kwargs['form_kwargs'] = {'project_widget': PrerenderedSelect(choices=choices)}
+        super(BaseParticipationAssignFormSet, self).__init__(*args, **kwargs)
+
+    def add_fields(self, form, index):
+        super(BaseParticipationAssignFormSet, self).add_fields(form, index)
+        # The registered student is taken from the prefetched queryset; checking the hidden
+        # primary key against the database would cost one query per row.
+        form.fields['id'] = forms.IntegerField(initial=form.fields['id'].initial, required=False,
+                                               widget=forms.HiddenInput)
+
+    def clean(self):
+        super(BaseParticipationAssignFormSet, self).clean()
+        if any(form.instance.pk is None for form in self.forms):
+            raise forms.ValidationError('Los estudiantes de las prácticas han cambiado. Recargue la página.')
+
+        # Participations are written in bulk, without their clean(), so eligibility is checked here at once
+        forms = [form for form in self.forms if form.has_changed() and form.is_valid() and
+                 form.cleaned_data['project'] is not None]
+        ineligible = ineligible_pairs((form.instance.pk, form.cleaned_data['project']) for form in forms)
+        for form in forms:
+            if (form.instance.pk, form.cleaned_data['project']) in ineligible:
+                form.add_error('project', INELIGIBLE_MESSAGE)
+
+
+ParticipationAssignFormSet = forms.modelformset_factory(RegisteredStudent, form=ParticipationAssignForm,
+                                                        formset=BaseParticipationAssignFormSet, extra=0,
+                                                        max_num=settings.ASSIGN_MAX_STUDENTS)
 
 
 class ParticipationForm(forms.ModelForm):
@@ -128,6 +279,19 @@ class ParticipationForm(forms.ModelForm):
         exclude = ('reg_student', 'project')
 
 
+class ParticipationEvaluationForm(forms.Form):
+    proposed_grade = forms.IntegerField(label='Calificación propuesta', min_value=0, max_value=5, required=False,
+                                        error_messages={'max_value': 'La máxima calificación es 5.'})
+    tutor_report = forms.FileField(label='Informe del tutor', required=False)
+
+    def __init__(self, *args, **kwargs):
+        # Plain form instead of a ModelForm: model validation would query the project's practices for every row
+        participation = kwargs.pop('participation')
+        kwargs['initial'] = {'proposed_grade': participation.proposed_grade, 'tutor_report': participation.tutor_report}
+        super(ParticipationEvaluationForm, self).__init__(*args, **kwargs)
+        self.participation = participation
+
+
 class ParticipationAdminForm(forms.ModelForm):
     grade = forms.IntegerField(max_value=5, min_value=2, required=False)
 
@@ -142,6 +306,18 @@ class CourseForm(forms.ModelForm):
         exclude = ()
 
 
+class StudentImportForm(forms.Form):
+    file = forms.FileField(label='Fichero', help_text='CSV (UTF-8) o XLSX.')
+    course = forms.ModelChoiceField(Course.objects.order_by('-start'), label='Curso', required=False,
+                                    help_text='Curso de las filas que no lo indican.')
+    password = forms.CharField(widget=forms.PasswordInput, label='Contraseña', required=False,
+                               help_text='Contraseña de los nuevos usuarios que no la indican.')
+
+    def __init__(self, *args, **kwargs):
+        super(StudentImportForm, self).__init__(*args, **kwargs)
+        self.fields['course'].initial = get_current_course()
+
+
 class RegisteredStudentForm(forms.ModelForm):
     course = forms.ModelChoiceField(Course.objects.all(), label='Curso')
     major = forms.ModelChoiceField(Major.objects.all(), label='Carrera')
@@ -182,8 +358,13 @@ class ProjectForm(forms.ModelForm):
         super(ProjectForm, self).__init__(*args, **kwargs)
         instance = kwargs.get('instance', None)
 
-        self.fields['practices'].queryset = Practice.objects.filter(course=instance.course) if instance \
-            else Practice.objects.filter(start__gt=date.today())
+        course = instance.course if instance else get_current_course()
+        if course is None:
+            self.fields['practices'].queryset = Practice.objects.none()
+        elif instance:
+            self.fields['practices'].queryset = Practice.objects.filter(course=course)
+        else:
+            self.fields['practices'].queryset = Practice.objects.filter(course=course, start__gt=date.today())
 
     class Meta:
         model = Project
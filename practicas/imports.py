@@ -0,0 +1,252 @@
+import codecs
+import csv
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import chain, islice
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from . import roles
+from .models import Course, Practice, RegisteredStudent, Student, students_registered
+
+# Column -> header of the file, which may also use the column name itself
+COLUMNS = [
+    ('username', 'Usuario'),
+    ('first_name', 'Nombre'),
+    ('last_name', 'Apellidos'),
+    ('email', 'Email'),
+    ('password', 'Contraseña'),
+    ('course', 'Curso'),
+    ('major', 'Carrera'),
+    ('year', 'Año'),
+    ('group', 'Grupo'),
+]
+REQUIRED = ['username', 'major', 'year', 'group']
+CHUNK_SIZE = 500
+
+
+class ImportResult(object):
+    """Rows created by an import and the errors of the rows left out, as (row number, message)."""
+
+    def __init__(self):
+        self.users = 0
+        self.registered = 0
+        self.errors = []
+
+
+def read_csv(file, encoding='utf-8-sig'):
+    """Rows of a CSV file opened in binary mode, read line by line. The delimiter is sniffed from the header."""
+    lines = codecs.iterdecode(file, encoding)
+    header = next(lines, None)
+    if header is None:
+        return
+    try:
+        dialect = csv.Sniffer().sniff(header, delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    for row in csv.reader(chain([header], lines), dialect):
+        yield row
+
+
+def read_xlsx(file):
+    """Rows of the first sheet of an XLSX file. It needs openpyxl, which is optional."""
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise ValueError('Para importar ficheros XLSX hace falta instalar openpyxl.')
+
+    workbook = load_workbook(file, read_only=True, data_only=True)
+    try:
+        for row in workbook.active.iter_rows():
+            yield ['' if cell.value is None else str(cell.value) for cell in row]
+    finally:
+        workbook.close()
+
+
+def read_rows(file, name):
+    return read_xlsx(file) if name.lower().endswith('.xlsx') else read_csv(file)
+
+
+def _columns(header):
+    names = {}
+    for column, label in COLUMNS:
+        names[column] = names[label.lower()] = column
+    columns = [names.get(value.strip().lower()) for value in header]
+    missing = [label for column, label in COLUMNS if column in REQUIRED and column not in columns]
+    if missing:
+        raise ValueError('Faltan las columnas {0}.'.format(', '.join(missing)))
+    return columns
+
+
+def _integer(value):
+    try:
+        return int(value)
+    except ValueError:
+        # Spreadsheets store whole numbers as floats
+        number = float(value)
+        if not number.is_integer():
+            raise
+        return int(number)
+
+
+def _parse(record, courses, practices, course):
+    """Validate the fields of a row that don't depend on the database, resolving its practice."""
+    errors = []
+    row = dict(record)
+    try:
+        row['username'] = User._meta.get_field('username').clean(record.get('username', ''), None)
+    except ValidationError as e:
+        errors.extend(e.messages)
+    if row.get('email'):
+        try:
+            row['email'] = User._meta.get_field('email').clean(record['email'], None)
+        except ValidationError as e:
+            errors.extend(e.messages)
+    if not row.get('group'):
+        errors.append('Falta el grupo.')
+
+    if row.get('course'):
+        course = courses.get(row['course'])
+        if course is None:
+            errors.append('No existe el curso {0}.'.format(row['course']))
+    elif course is None:
+        errors.append('Falta el curso.')
+
+    try:
+        year = _integer(row.get('year', ''))
+    except ValueError:
+        errors.append('El año debe ser un número.')
+    else:
+        if course is not None:
+            key = (course, row.get('major', '').lower(), year)
+            if practices.get(key) is None:
+                errors.append('Hay varias prácticas para el mismo curso, carrera y año.' if key in practices else
+                              'No existe una práctica asignable al estudiante. '
+                              'Verifique los datos de curso, carrera y año.')
+            row['course'], row['practice'] = course, practices.get(key)
+
+    if errors:
+        raise ValidationError(errors)
+    return row
+
+
+@contextmanager
+def password_hasher(workers=None):
+    """
+    Function hashing a list of passwords. Hashing is slow on purpose, so it is spread over a pool of
+    ``workers`` processes (one per CPU by default); a single worker hashes in this process.
+    """
+    workers = workers or getattr(settings, 'IMPORT_HASH_WORKERS', None) or os.cpu_count() or 1
+    if workers == 1:
+        yield lambda passwords: [make_password(password) for password in passwords]
+        return
+    with ProcessPoolExecutor(workers) as pool:
+        yield lambda passwords: list(pool.map(make_password, passwords,
+                                              chunksize=max(1, len(passwords) // (workers * 4))))
+
+
+def _write(rows, hasher, seen, result, password):
+    """Create the users, students and registrations of a chunk of parsed rows."""
+    if not rows:
+        return
+    usernames = {row['username'] for line, row in rows}
+    existing = {user.username: user for user in User.objects.filter(username__in=usernames).select_related('student')}
+    registered = set(RegisteredStudent.objects.filter(student__user__username__in=usernames)
+                     .values_list('student__user__username', 'course'))
+
+    new_users = {}
+    registrations = []
+    for line, row in rows:
+        key = (row['username'], row['course'])
+        user = existing.get(row['username'])
+        if key in seen or key in registered:
+            result.errors.append((line, 'El estudiante ya está registrado en el curso.'))
+            continue
+        if user is not None and not hasattr(user, 'student'):
+            result.errors.append((line, 'El usuario ya existe y no es un estudiante.'))
+            continue
+        if user is None and row['username'] not in new_users:
+            missing = [label for column, label in COLUMNS if column in ('first_name', 'last_name', 'email')
+                       and not row.get(column)]
+            if not row.get('password') and not password:
+                missing.append('Contraseña')
+            if missing:
+                result.errors.append((line, 'Faltan los datos del nuevo usuario: {0}.'.format(', '.join(missing))))
+                continue
+            new_users[row['username']] = row
+        seen.add(key)
+        registrations.append(row)
+
+    hashes = hasher([row.get('password') or password for row in new_users.values()])
+    with transaction.atomic():
+        User.objects.bulk_create(User(username=row['username'], first_name=row['first_name'],
+                                      last_name=row['last_name'], email=row['email'], password=hashed)
+                                 for row, hashed in zip(new_users.values(), hashes))
+        users = list(User.objects.filter(username__in=new_users))
+        roles.grant(roles.STUDENT, users)
+        Student.objects.bulk_create(Student(user=user) for user in users)
+
+        students = dict(Student.objects.filter(user__username__in={row['username'] for row in registrations})
+                        .values_list('user__username', 'id'))
+        RegisteredStudent.objects.bulk_create(
+            RegisteredStudent(student_id=students[row['username']], practice_id=row['practice'],
+                              course_id=row['course'], group=row['group']) for row in registrations)
+        reg_students = list(RegisteredStudent.objects.filter(
+            student__in=students.values(), course__in={row['course'] for row in registrations})
+                            .values_list('id', flat=True))
+
+    result.users += len(users)
+    result.registered += len(registrations)
+    if registrations:
+        students_registered.send(sender=RegisteredStudent, reg_students=reg_students)
+
+
+def import_students(rows, course=None, password=None, chunk_size=CHUNK_SIZE, workers=None):
+    """
+    Register students in their practices from ``rows``, a header and then one row per student as
+    given by :func:`read_rows`. Rows are consumed ``chunk_size`` at a time, each chunk written with
+    a few bulk queries in its own transaction, so files of any size take little memory.
+
+    Practices are resolved by course, major and year; rows without a course use ``course``. Students
+    who already have a user are just registered; new users get the row's password or ``password``.
+    Invalid rows are skipped and reported in the returned :class:`ImportResult`.
+    """
+    rows = iter(rows)
+    header = next(rows, None)
+    if header is None:
+        raise ValueError('El fichero está vacío.')
+    columns = _columns(header)
+
+    courses = {str(c): c.pk for c in Course.objects.all()}
+    practices = {}
+    for practice_id, course_id, major, year in Practice.objects.values_list('id', 'course', 'major__name', 'year'):
+        key = (course_id, major.lower(), year)
+        practices[key] = None if key in practices else practice_id
+    course = course.pk if isinstance(course, Course) else course
+
+    result = ImportResult()
+    seen = set()
+    line = 1
+    with password_hasher(workers) as hasher:
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            parsed = []
+            for values in chunk:
+                line += 1
+                record = {column: value.strip() for column, value in zip(columns, values) if column}
+                if not any(record.values()):
+                    continue
+                try:
+                    parsed.append((line, _parse(record, courses, practices, course)))
+                except ValidationError as e:
+                    result.errors.append((line, ' '.join(e.messages)))
+            _write(parsed, hasher, seen, result, password)
+    result.errors.sort()
+    return result
@@ -0,0 +1,118 @@
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .assignment import reassign, save_assignment
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+JOB_KEY = 'practicas:job:{0}'
+LATEST_KEY = 'practicas:job:practice:{0}'
+ACTIVE_KEY = 'practicas:job:practice:{0}:active'
+TIMEOUT = 24 * 60 * 60
+# A job whose process died no longer blocks its practice after this long
+ACTIVE_TIMEOUT = 60 * 60
+
+_executor = ThreadPoolExecutor(max_workers=getattr(settings, 'ASSIGNMENT_JOB_WORKERS', 2))
+
+
+class AssignmentJob(object):
+    """
+    Automatic assignment of the projects of a practice, executed by the local worker pool. Its state
+    is stored in the default cache on every change, so any process can report its progress.
+    """
+
+    def __init__(self, practice):
+        self.id = uuid.uuid4().hex
+        self.practice = practice
+        self.status = PENDING
+        self.progress = 0
+        self.step = 'En cola'
+        self.summary = None
+        self.error = None
+        self.created = timezone.now()
+        self.finished = None
+
+    @property
+    def active(self):
+        return self.status in (PENDING, RUNNING)
+
+    def save(self):
+        cache.set(JOB_KEY.format(self.id), self, TIMEOUT)
+
+    def _update(self, progress, step):
+        self.progress = progress
+        self.step = step
+        self.save()
+
+    def run(self):
+        close_old_connections()
+        self.status = RUNNING
+        try:
+            # Only the changes since the previous run are recomputed, if there was one
+            self._update(20, 'Calculando asignación')
+            problem, assignment = reassign(self.practice)
+
+            self._update(80, 'Guardando participaciones')
+            save_assignment(problem, assignment)
+
+            self.summary = {
+                'assigned': len(assignment.projects),
+                'first_choice': sum(1 for rank in assignment.ranks.values() if rank == 0),
+                'unassigned': len(assignment.unassigned),
+            }
+            self._update(100, 'Terminado')
+            self.status = DONE
+        except Exception as e:
+            self.error = str(e)
+            self.status = FAILED
+        finally:
+            self.finished = timezone.now()
+            self.save()
+            cache.delete(ACTIVE_KEY.format(self.practice.id))
+            close_old_connections()
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'progress': self.progress,
+            'step': self.step,
+            'summary': self.summary,
+            'error': self.error,
+        }
+
+
+def enqueue_assignment(practice):
+    """
+    Queue an assignment job for the practice, or return the one already queued or running. Only one
+    process can claim the practice at a time, and only the last job of each practice is kept.
+    """
+    key = ACTIVE_KEY.format(practice.id)
+    job = AssignmentJob(practice)
+    while not cache.add(key, job.id, ACTIVE_TIMEOUT):
+        active = get_job(cache.get(key))
+        if active is not None and active.active:
+            return active
+        # The claim belongs to a job that finished or vanished meanwhile
+        cache.delete(key)
+
+    job.save()
+    cache.set(LATEST_KEY.format(practice.id), job.id, TIMEOUT)
+    _executor.submit(job.run)
+    return job
+
+
+def get_job(job_id):
+    return cache.get(JOB_KEY.format(job_id)) if job_id else None
+
+
+def latest_job(practice):
+    return get_job(cache.get(LATEST_KEY.format(practice.id)))
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from practicas.courses import get_current_course
+from practicas.imports import CHUNK_SIZE, import_students, read_rows
+from practicas.models import Course
+
+
+class Command(BaseCommand):
+    help = 'Creates the students of a CSV or XLSX file and registers them in their practices.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help='CSV (UTF-8) or XLSX file with a header row.')
+        parser.add_argument('--course',
+                            help='Course of the rows without one, as 2017-2018; the current one by default.')
+        parser.add_argument('--password', help='Password of the new users without one.')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='Rows written at a time.')
+        parser.add_argument('--workers', type=int, help='Processes hashing passwords, one per CPU by default.')
+
+    def handle(self, *args, **options):
+        course = get_current_course()
+        if options['course']:
+            course = next((c for c in Course.objects.all() if str(c) == options['course']), None)
+            if course is None:
+                raise CommandError('No existe el curso {0}.'.format(options['course']))
+
+        with open(options['file'], 'rb') as f:
+            try:
+                result = import_students(read_rows(f, options['file']), course, options['password'],
+                                         options['chunk_size'], options['workers'])
+            except ValueError as e:
+                raise CommandError(str(e))
+
+        for line, message in result.errors:
+            self.stdout.write('Fila {0}: {1}'.format(line, message))
+        self.stdout.write(self.style.SUCCESS('{0} estudiante(s) registrado(s), {1} usuario(s) nuevo(s).'.format(
+            result.registered, result.users)))
+        if result.errors:
+            self.stdout.write(self.style.WARNING('{0} fila(s) con errores.'.format(len(result.errors))))
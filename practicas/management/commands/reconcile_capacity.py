@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from practicas.capacity import reconcile
+from practicas.models import Requirement
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the remaining seats of every requirement from the existing participations and reports drift.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help='Store the recomputed seats.')
+
+    def handle(self, *args, **options):
+        drift = reconcile(fix=options['fix'])
+        requirements = Requirement.objects.select_related('project', 'major') \
+            .in_bulk([req_id for req_id, _, _ in drift])
+        for req_id, stored, expected in drift:
+            requirement = requirements[req_id]
+            self.stdout.write('{0} ({1} {2}): {3} plazas registradas, {4} esperadas'.format(
+                requirement.project, requirement.major, requirement.year, stored, expected))
+
+        if not drift:
+            self.stdout.write(self.style.SUCCESS('Sin diferencias.'))
+        elif options['fix']:
+            self.stdout.write(self.style.SUCCESS('{0} requisito(s) corregido(s).'.format(len(drift))))
+        else:
+            self.stdout.write(self.style.WARNING('{0} requisito(s) con diferencias.'.format(len(drift))))
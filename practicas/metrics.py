@@ -0,0 +1,175 @@
+"""
+In-memory request metrics per view: SQL queries, database time, template render time and wall
+time. Samples are kept in a rolling window per view and live in the process that served the
+requests, so every worker reports its own figures.
+"""
+import threading
+import time
+from collections import OrderedDict, deque
+
+from django.conf import settings
+from django.template.base import Template
+
+FIELDS = OrderedDict([
+    ('queries', 'SQL queries per request.'),
+    ('db_seconds', 'Time spent in the database per request, in seconds.'),
+    ('template_seconds', 'Time spent rendering templates per request, in seconds.'),
+    ('wall_seconds', 'Total time per request, in seconds.'),
+])
+QUANTILES = (0.5, 0.9, 0.95, 0.99)
+
+_views = {}
+_lock = threading.Lock()
+_local = threading.local()
+
+
+class ViewStats(object):
+    """Rolling window of samples of a view, plus running totals since the process started."""
+
+    def __init__(self, window):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.sums = dict.fromkeys(FIELDS, 0)
+
+    def add(self, sample):
+        self.samples.append(sample)
+        self.count += 1
+        for field in FIELDS:
+            self.sums[field] += sample[field]
+
+    def quantiles(self, field):
+        values = sorted(sample[field] for sample in self.samples)
+        if not values:
+            return OrderedDict()
+        result = OrderedDict((q, values[min(int(q * len(values)), len(values) - 1)]) for q in QUANTILES)
+        result[1.0] = values[-1]
+        return result
+
+
+def record(view, queries, db_seconds, template_seconds, wall_seconds):
+    sample = {
+        'queries': queries,
+        'db_seconds': db_seconds,
+        'template_seconds': template_seconds,
+        'wall_seconds': wall_seconds,
+    }
+    with _lock:
+        stats = _views.get(view)
+        if stats is None:
+            stats = _views[view] = ViewStats(getattr(settings, 'METRICS_WINDOW', 1000))
+        stats.add(sample)
+
+
+def reset():
+    with _lock:
+        _views.clear()
+
+
+def snapshot():
+    """Percentiles and totals of every view, ready to be serialized."""
+    with _lock:
+        views = sorted(_views.items())
+        result = OrderedDict()
+        for view, stats in views:
+            data = OrderedDict([('count', stats.count)])
+            for field in FIELDS:
+                quantiles = stats.quantiles(field)
+                data[field] = OrderedDict([
+                    ('p50', quantiles.get(0.5)),
+                    ('p95', quantiles.get(0.95)),
+                    ('p99', quantiles.get(0.99)),
+                    ('max', quantiles.get(1.0)),
+                    ('mean', stats.sums[field] / stats.count),
+                ])
+            result[view] = data
+    return result
+
+
+def prometheus():
+    """Metrics in the Prometheus text exposition format, one summary per field."""
+    with _lock:
+        views = sorted(_views.items())
+        lines = []
+        for field, help_text in FIELDS.items():
+            name = 'practicas_view_{0}'.format(field)
+            lines.append('# HELP {0} {1}'.format(name, help_text))
+            lines.append('# TYPE {0} summary'.format(name))
+            for view, stats in views:
+                label = view.replace('\\', '\\\\').replace('"', '\\"')
+                for q, value in stats.quantiles(field).items():
+                    if q < 1.0:
+                        lines.append('{0}{{view="{1}",quantile="{2}"}} {3}'.format(name, label, q, value))
+                lines.append('{0}_sum{{view="{1}"}} {2}'.format(name, label, stats.sums[field]))
+                lines.append('{0}_count{{view="{1}"}} {2}'.format(name, label, stats.count))
+    return '\n'.join(lines) + '\n'
+
+
+def query_budget(view):
+    """Maximum number of queries allowed to the view, from ``QUERY_BUDGETS`` or ``QUERY_BUDGET``."""
+    return getattr(settings, 'QUERY_BUDGETS', {}).get(view, getattr(settings, 'QUERY_BUDGET', None))
+
+
+def start_template_timer():
+    _local.template_seconds = 0
+    _local.depth = 0
+
+
+def template_seconds():
+    return getattr(_local, 'template_seconds', 0)
+
+
+def _timed_render(self, context):
+    # Included and extended templates are rendered inside their parent: only the outermost counts
+    depth = getattr(_local, 'depth', 0)
+    _local.depth = depth + 1
+    start = time.perf_counter()
+    try:
+        return _original_render(self, context)
+    finally:
+        _local.depth = depth
+        if depth == 0:
+            _local.template_seconds = template_seconds() + time.perf_counter() - start
+
+
+_original_render = Template._render
+
+
+def instrument_templates():
+    """
+    Time template rendering, by wrapping ``Template._render`` once when the app is ready. It can be
+    called again to wrap a ``_render`` replaced afterwards, e.g. by ``setup_test_environment``.
+    """
+    global _original_render
+    with _lock:
+        if Template._render is not _timed_render:
+            _original_render = Template._render
+            Template._render = _timed_render
+
+
+class QueryLog(deque):
+    """
+    Log of the queries of a connection that also counts every query ever logged, as the log itself
+    drops the oldest ones once full and its length stops growing.
+    """
+
+    def __init__(self, log):
+        super(QueryLog, self).__init__(log, maxlen=log.maxlen)
+        self.total = len(log)
+
+    def append(self, query):
+        self.total += 1
+        super(QueryLog, self).append(query)
+
+
+def query_log(connection):
+    if not isinstance(connection.queries_log, QueryLog):
+        connection.queries_log = QueryLog(connection.queries_log)
+    return connection.queries_log
+
+
+def count_queries():
+    """
+    Whether queries are counted, which needs the debug cursor. It slows every query down, so it is
+    only forced when ``METRICS_QUERIES`` is set; otherwise queries are only counted with ``DEBUG``.
+    """
+    return getattr(settings, 'METRICS_QUERIES', False)
@@ -0,0 +1,133 @@
+import logging
+import time
+from datetime import date
+
+from django.core.cache import cache
+from django.db import connections
+from django.utils.deprecation import MiddlewareMixin
+from django.utils.functional import SimpleLazyObject
+
+from . import metrics
+from .courses import get_current_course
+from .models import PracticeManager, RegisteredStudent
+
+VERSION_KEY = 'practicas:role:version'
+CACHE_KEY = 'practicas:role:{0}:{1}:{2}'
+TIMEOUT = 24 * 60 * 60
+
+logger = logging.getLogger(__name__)
+
+
+class CurrentRole(object):
+    """
+    Registered student, practice manager and practice of a user in the current course, if any. A user
+    may be both, in which case the practice is the one the user studies in.
+    """
+
+    def __init__(self, reg_student=None, manager=None):
+        self.reg_student = reg_student
+        self.manager = manager
+        self.practice = reg_student.practice if reg_student else manager.practice if manager else None
+
+
+def get_role(user):
+    if not user.is_authenticated:
+        return CurrentRole()
+
+    course = get_current_course()
+    if course is None:
+        return CurrentRole()
+
+    key = CACHE_KEY.format(cache.get_or_set(VERSION_KEY, 1, None), user.pk, date.today().isoformat())
+    role = cache.get(key)
+    if role is None:
+        reg_student = RegisteredStudent.objects.select_related('practice__course', 'practice__major') \
+            .filter(student__user=user, practice__course=course).first()
+        manager = PracticeManager.objects.select_related('practice__course', 'practice__major') \
+            .filter(user=user, practice__course=course).first()
+        role = CurrentRole(reg_student, manager)
+        if reg_student or manager:
+            # Users without a role are not cached: they may get one through a write that sends no signal
+            cache.set(key, role, TIMEOUT)
+    return role
+
+
+def invalidate():
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        pass
+
+
+class CurrentRoleMiddleware(MiddlewareMixin):
+    """
+    Exposes the user's :class:`CurrentRole` as ``request.role``. It is resolved on first use and
+    cached per user and day, so views don't repeat the same joins on every hit.
+    """
+
+    def process_request(self, request):
+        request.role = SimpleLazyObject(lambda: get_role(request.user))
+
+
+class MetricsMiddleware(MiddlewareMixin):
+    """
+    Records the queries, database time, template render time and wall time of every request under
+    its URL name (see :mod:`practicas.metrics`), and logs a warning when a view runs more queries
+    than its budget. It should be the first middleware so the wall time covers the others. Streaming
+    responses are recorded once their content is sent.
+    """
+
+    def process_request(self, request):
+        metrics.start_template_timer()
+        request._metrics_debug_cursor = {}
+        request._metrics_queries = {}
+        force = metrics.count_queries()
+        for connection in connections.all():
+            if force or connection.queries_logged:
+                request._metrics_debug_cursor[connection.alias] = connection.force_debug_cursor
+                request._metrics_queries[connection.alias] = metrics.query_log(connection).total
+                connection.force_debug_cursor = True
+        request._metrics_start = time.perf_counter()
+
+    def process_response(self, request, response):
+        if not hasattr(request, '_metrics_start'):
+            return response
+        if response.streaming:
+            response.streaming_content = self._stream(request, response.streaming_content)
+        else:
+            self._record(request)
+        return response
+
+    def _stream(self, request, content):
+        try:
+            for chunk in content:
+                yield chunk
+        finally:
+            self._record(request)
+
+    def _record(self, request):
+        wall_seconds = time.perf_counter() - request._metrics_start
+
+        queries = 0
+        db_seconds = 0
+        for connection in connections.all():
+            if connection.alias not in request._metrics_queries:
+                continue
+            log = metrics.query_log(connection)
+            count = log.total - request._metrics_queries[connection.alias]
+            recent = list(log)[-count:] if count else []
+            queries += count
+            db_seconds += sum(float(query['time']) for query in recent)
+            connection.force_debug_cursor = request._metrics_debug_cursor[connection.alias]
+            if not connection.queries_logged:
+                # Nobody else asked for the log, so it is left as it was
+                for query in recent:
+                    log.pop()
+
+        match = request.resolver_match
+        view = match.view_name if match else '<unresolved>'
+        metrics.record(view, queries, db_seconds, metrics.template_seconds(), wall_seconds)
+
+        budget = metrics.query_budget(view)
+        if budget is not None and queries > budget:
+            logger.warning('%s ran %d queries, over its budget of %d (%s)', view, queries, budget, request.path)
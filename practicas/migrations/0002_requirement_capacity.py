@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import defaultdict
+
+from django.db import migrations, models
+
+
+def set_capacity(apps, schema_editor):
+    Requirement = apps.get_model('practicas', 'Requirement')
+    Participation = apps.get_model('practicas', 'Participation')
+
+    requirements = list(Requirement.objects.values_list('id', 'project', 'major', 'year', 'students_count'))
+    candidates = defaultdict(list)
+    for req_id, project_id, major_id, year, _ in requirements:
+        candidates[project_id, major_id].append((year, req_id))
+
+    # Capacities are unknown yet, so every participation took its seat from the highest year requirement
+    taken = defaultdict(int)
+    for part in Participation.objects.exclude(project=None) \
+            .values('project', 'reg_student__practice__major', 'reg_student__practice__year') \
+            .annotate(count=models.Count('pk')).order_by():
+        eligible = [(year, req_id) for year, req_id in candidates[part['project'], part['reg_student__practice__major']]
+                    if year <= part['reg_student__practice__year']]
+        if eligible:
+            taken[max(eligible)[1]] += part['count']
+
+    for req_id, _, _, _, students_count in requirements:
+        Requirement.objects.filter(pk=req_id).update(capacity=students_count + taken[req_id])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('practicas', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='requirement',
+            name='capacity',
+            field=models.IntegerField(editable=False, null=True, verbose_name='capacidad'),
+        ),
+        migrations.RunPython(set_capacity, migrations.RunPython.noop),
+    ]
@@ -1,10 +1,13 @@
 import os
+from collections import defaultdict
 
-from django.contrib.auth.models import User, Group, Permission
+from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
 from django.core.files.storage import FileSystemStorage
 from django.core.validators import MinValueValidator, MaxValueValidator
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Count, F
+from django.dispatch import Signal
 from django.template.defaultfilters import slugify
 
 from bd.settings import MEDIA_ROOT
@@ -19,13 +22,56 @@ class OverwriteStorage(FileSystemStorage):
 
 fs = OverwriteStorage(location=MEDIA_ROOT)
 
+# Sent after a bulk write of participations, which bypasses post_save
+participations_assigned = Signal(providing_args=['reg_students', 'projects'])
+# Sent after a bulk import of registered students
+students_registered = Signal(providing_args=['reg_students'])
+# Sent once after deleting the requests no longer eligible for their project
+requests_pruned = Signal(providing_args=['reg_students'])
+# Sent after seats of requirements are taken or given back with conditional updates, which bypass post_save
+seats_changed = Signal(providing_args=['projects'])
+
+
+def chunks(items, size=500):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+INELIGIBLE_MESSAGE = 'El estudiante registrado y el proyecto deben corresponder a las mismas prácticas, y el ' \
+                     'proyecto debe admitir estudiantes de su carrera y año.'
+
+
+def eligible_students(projects):
+    """
+    Registered students whose practice is one of the project's and that some requirement of that
+    same project admits, by major and a year not above theirs.
+    """
+    return RegisteredStudent.objects.filter(practice__project__in=projects,
+                                            practice__project__requirement__major=F('practice__major'),
+                                            practice__project__requirement__year__lte=F('practice__year'))
+
+
+def ineligible_pairs(pairs):
+    """
+    The (reg_student_id, project_id) pairs of ``pairs`` where the student can't take the project,
+    checked with one query per 500 students: for a whole formset or import batch at once.
+    """
+    pairs = set(pairs)
+    projects = {project_id for _, project_id in pairs}
+    eligible = set()
+    for students in chunks({rs_id for rs_id, _ in pairs}):
+        eligible.update(eligible_students(projects).filter(pk__in=students)
+                        .values_list('pk', 'practice__project').distinct())
+    return pairs - eligible
+
 
 def validate_student_project_practice(self):
-    try:
-        if self.reg_student.practice not in self.project.practices.iterator():
-            raise ValidationError("El estudiante registrado y el proyecto deben corresponder a las mismas prácticas.")
-    except AttributeError:
-        pass
+    # Formsets check every form at once instead, see BatchEligibilityFormSet
+    if self.reg_student_id is None or self.project_id is None or getattr(self, '_eligibility_checked', False):
+        return
+    if not eligible_students([self.project_id]).filter(pk=self.reg_student_id).exists():
+        raise ValidationError(INELIGIBLE_MESSAGE)
 
 
 def make_project_report_name(instance, filename):
@@ -47,8 +93,9 @@ class Student(models.Model):
     user = models.OneToOneField(User, verbose_name='usuario', unique=True)
 
     def save(self, *args, **kwargs):
-        student_permissions = Permission.objects.get(codename='student_permissions')
-        self.user.user_permissions.add(student_permissions)
+        from .roles import grant, STUDENT
+
+        grant(STUDENT, [self.user])
         super(Student, self).save(*args, **kwargs)
 
     def __str__(self):
@@ -162,6 +209,27 @@ class Project(models.Model):
         verbose_name = 'proyecto'
 
 
+class RequestQuerySet(models.QuerySet):
+    def ineligible(self):
+        """Requests whose project has no requirement left for the major and year of the student."""
+        eligible = self.filter(project__requirement__major=F('reg_student__practice__major'),
+                               project__requirement__year__lte=F('reg_student__practice__year'))
+        return self.exclude(pk__in=eligible.values('pk'))
+
+    def prune(self):
+        """
+        Delete the ineligible requests, selected by a single query against a subquery of the remaining
+        requirements however many there are. Returns the number of requests deleted.
+        """
+        ineligible = self.ineligible()
+        reg_students = set(ineligible.values_list('reg_student', flat=True))
+        if not reg_students:
+            return 0
+        deleted, _ = ineligible.delete()
+        requests_pruned.send(sender=Request, reg_students=reg_students)
+        return deleted
+
+
 class Request(models.Model):
     reg_student = models.ForeignKey('RegisteredStudent', verbose_name='estudiante registrado')
     project = models.ForeignKey('Project', verbose_name='proyecto')
@@ -169,6 +237,8 @@ class Request(models.Model):
     priority = models.PositiveIntegerField('prioridad', default=1)
     checked = models.BooleanField('confirmación del tutor', default=False)
 
+    objects = RequestQuerySet.as_manager()
+
     def clean(self):
         validate_student_project_practice(self)
 
@@ -181,6 +251,67 @@ class Request(models.Model):
         unique_together = ('reg_student', 'project')
 
 
+class ParticipationQuerySet(models.QuerySet):
+    def bulk_assign(self, projects, grades=None):
+        """
+        Set the project and grade of many registered students at once, creating their participations
+        if needed. ``projects`` and ``grades`` map registered student ids to project ids and grades;
+        students missing from either keep their current value.
+
+        Seats are computed in memory for the whole batch and written with one update per distinct
+        change, all in a single transaction.
+        """
+        from .capacity import notify, plan_seats
+
+        grades = grades or {}
+        students = set(projects) | set(grades)
+        existing = {}
+        practices = {}
+        for ids in chunks(students):
+            for rs_id, pk, project_id, grade in Participation.objects.filter(reg_student__in=ids) \
+                    .values_list('reg_student', 'id', 'project', 'grade'):
+                existing[rs_id] = (pk, project_id, grade)
+            for rs_id, major_id, year in RegisteredStudent.objects.filter(pk__in=ids) \
+                    .values_list('id', 'practice__major', 'practice__year'):
+                practices[rs_id] = (major_id, year)
+
+        new = []
+        updates = defaultdict(list)
+        moves = []
+        for rs_id in sorted(students):
+            pk, old_project_id, old_grade = existing.get(rs_id, (None, None, None))
+            project_id = projects.get(rs_id, old_project_id)
+            grade = grades.get(rs_id, old_grade)
+            if pk is None:
+                new.append(Participation(reg_student_id=rs_id, project_id=project_id, grade=grade))
+            elif (project_id, grade) != (old_project_id, old_grade):
+                updates[project_id, grade].append(pk)
+            if project_id != old_project_id:
+                moves.append((old_project_id, project_id) + practices[rs_id])
+
+        touched = {project_id for move in moves for project_id in move[:2] if project_id}
+        with transaction.atomic():
+            requirements = Requirement.objects.filter(project__in=touched) \
+                .values_list('id', 'project', 'major', 'year', 'students_count', 'capacity')
+            participants = {(project_id, major_id): count for project_id, major_id, count in Participation.objects
+                            .filter(project__in=touched).values('project', 'reg_student__practice__major')
+                            .annotate(count=Count('pk')).values_list('project', 'reg_student__practice__major',
+                                                                     'count')}
+            by_delta = defaultdict(list)
+            for req_id, change in plan_seats(requirements, moves, participants).items():
+                by_delta[change].append(req_id)
+
+            Participation.objects.bulk_create(new, batch_size=500)
+            for (project_id, grade), pks in updates.items():
+                for ids in chunks(pks):
+                    Participation.objects.filter(pk__in=ids).update(project=project_id, grade=grade)
+            for change, req_ids in by_delta.items():
+                Requirement.objects.filter(pk__in=req_ids).update(students_count=F('students_count') + change)
+
+        notify(touched)
+        participations_assigned.send(sender=Participation, reg_students=students, projects=touched)
+
+
 class Participation(models.Model):
     project = models.ForeignKey('Project', verbose_name='proyecto', blank=True, null=True)
     reg_student = models.OneToOneField('RegisteredStudent', verbose_name='estudiante registrado')
@@ -196,37 +327,51 @@ class Participation(models.Model):
     tutor_report = models.FileField('informe del tutor', blank=True, storage=fs,
                                     upload_to=make_participation_tutor_report_name)
 
+    objects = ParticipationQuerySet.as_manager()
+
     def clean(self):
         validate_student_project_practice(self)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Participation, cls).from_db(db, field_names, values)
+        # Remember the stored project, so saving doesn't need to fetch it again
+        instance._loaded_project_id = instance.project_id
+        return instance
+
+    def _major_and_year(self):
+        return RegisteredStudent.objects.filter(pk=self.reg_student_id) \
+            .values_list('practice__major', 'practice__year').get()
+
     def save(self, force_insert=False, force_update=False, using=None,
              update_fields=None):
-        try:
-            old_part = Participation.objects.get(reg_student=self.reg_student)
-        except Participation.DoesNotExist:
-            old_part = None
-
-        if (not old_part or old_part.project != self.project) and self.project:
-            requirement = Requirement.objects.filter(project=self.project, major=self.reg_student.practice.major,
-                                                     year__lte=self.reg_student.practice.year,
-                                                     students_count__gt=0).order_by('year').last()
-            if requirement:
-                requirement.students_count -= 1
-                requirement.save()
-        if old_part and old_part.project and old_part.project != self.project:
-            requirement = Requirement.objects.filter(project=old_part.project, major=self.reg_student.practice.major,
-                                                     year__lte=self.reg_student.practice.year).order_by('year').last()
-            if requirement:
-                requirement.students_count += 1
-                requirement.save()
-        super().save(force_insert, force_update, using, update_fields)
+        from .capacity import take_seat, release_seat
+
+        if hasattr(self, '_loaded_project_id'):
+            old_project_id = self._loaded_project_id
+        else:
+            old_project_id = Participation.objects.filter(reg_student=self.reg_student_id) \
+                .values_list('project', flat=True).first()
+
+        with transaction.atomic(using):
+            moved = old_project_id != self.project_id
+            if moved:
+                major, year = self._major_and_year()
+                if self.project_id:
+                    take_seat(self.project_id, major, year)
+            super().save(force_insert, force_update, using, update_fields)
+            if moved and old_project_id:
+                # Only once the student left, so the seat is given back if it held one
+                release_seat(old_project_id, major, year)
+        self._loaded_project_id = self.project_id
 
     def delete(self, using=None, keep_parents=False):
-        super().delete(using, keep_parents)
-        requirement = Requirement.objects.filter(project=self.project, major=self.reg_student.practice.major,
-                                                 year__lte=self.reg_student.practice.year).order_by('year').last()
-        requirement.students_count += 1
-        requirement.save()
+        from .capacity import release_seat
+
+        with transaction.atomic(using):
+            super().delete(using, keep_parents)
+            if self.project_id:
+                release_seat(self.project_id, *self._major_and_year())
 
     def __str__(self):
         return "{0} en {1} ({2})".format(self.reg_student.student, self.project, self.reg_student.course)
@@ -236,6 +381,16 @@ class Participation(models.Model):
         verbose_name_plural = 'participaciones'
 
 
+class RequirementQuerySet(models.QuerySet):
+    def delete(self):
+        """Delete the requirements and then, at once, the requests of their projects no longer eligible."""
+        projects = set(self.values_list('project', flat=True))
+        with transaction.atomic(using=self.db):
+            result = super(RequirementQuerySet, self).delete()
+            Request.objects.filter(project__in=projects).prune()
+        return result
+
+
 class Requirement(models.Model):
     project = models.ForeignKey('Project', verbose_name='proyecto')
     major = models.ForeignKey('Major', verbose_name='carrera')
@@ -245,15 +400,31 @@ class Requirement(models.Model):
                                    MinValueValidator(1, message='Toda carrera tiene duración mayor que 1 año.')])
     students_count = models.IntegerField('cantidad de estudiantes', validators=[
         MinValueValidator(1, "En el proyecto debe participar al menos 1 estudiante.")])
+    # Total seats, of which students_count are still free. Kept in sync when students_count is edited.
+    capacity = models.IntegerField('capacidad', editable=False, null=True)
 
-    def delete(self, using=None, keep_parents=False):
-        super(Requirement, self).delete(using, keep_parents)
+    objects = RequirementQuerySet.as_manager()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Requirement, cls).from_db(db, field_names, values)
+        instance._loaded_students_count = instance.students_count
+        return instance
 
-        requests = Request.objects.filter(project=self.project)
-        for req in requests:
-            if not Requirement.objects.filter(project=self.project, major=req.reg_student.major,
-                                              year__lte=req.reg_student.year).exists():
-                req.delete()
+    def save(self, *args, **kwargs):
+        loaded = getattr(self, '_loaded_students_count', None)
+        if self.capacity is None:
+            self.capacity = self.students_count
+        elif loaded is not None:
+            self.capacity += self.students_count - loaded
+        super(Requirement, self).save(*args, **kwargs)
+        self._loaded_students_count = self.students_count
+
+    def delete(self, using=None, keep_parents=False):
+        with transaction.atomic(using=using):
+            result = super(Requirement, self).delete(using, keep_parents)
+            Request.objects.filter(project=self.project_id).prune()
+        return result
 
     class Meta:
         verbose_name = 'requisito'
@@ -276,26 +447,12 @@ class Tutor(models.Model):
     job = models.CharField('puesto', max_length=200)
 
     def save(self, *args, **kwargs):
-        tutor_permissions = Permission.objects.get(codename='tutor_permissions')
-        self.user.user_permissions.add(tutor_permissions)
-
-        perms = [
-            Permission.objects.get(codename='change_participation'),
-
-            Permission.objects.get(codename='add_project'),
-            Permission.objects.get(codename='change_project'),
-            Permission.objects.get(codename='delete_project'),
-
-            Permission.objects.get(codename='change_request'),
-
-            Permission.objects.get(codename='add_requirement'),
-            Permission.objects.get(codename='change_requirement'),
-            Permission.objects.get(codename='delete_requirement'),
-        ]
+        from .roles import grant, TUTOR
 
+        # The user is saved anyway: the admin form edits it along with the tutor
         self.user.is_staff = True
-        self.user.user_permissions.add(perms)
         self.user.save()
+        grant(TUTOR, [self.user])
 
         super(Tutor, self).save(*args, **kwargs)
 
@@ -327,9 +484,9 @@ class PracticeManager(models.Model):
     practice = models.ForeignKey('Practice', verbose_name='práctica')
 
     def save(self, *args, **kwargs):
-        manager_permissions = Permission.objects.get(codename='manager_permissions')
-        self.user.user_permissions.add(manager_permissions)
-        self.user.save()
+        from .roles import grant, MANAGER
+
+        grant(MANAGER, [self.user])
         super(PracticeManager, self).save(*args, **kwargs)
 
     def __str__(self):
@@ -0,0 +1,63 @@
+from django.contrib.auth.models import Permission, User
+
+from .models import chunks
+
+STUDENT = 'student'
+TUTOR = 'tutor'
+MANAGER = 'manager'
+
+PERMISSIONS = {
+    STUDENT: ['student_permissions'],
+    TUTOR: ['tutor_permissions', 'change_participation', 'add_project', 'change_project', 'delete_project',
+            'change_request', 'add_requirement', 'change_requirement', 'delete_requirement'],
+    MANAGER: ['manager_permissions'],
+}
+
+_permission_ids = {}
+
+
+def permission_ids(role):
+    """Ids of the permissions of the role, fetched once per process."""
+    ids = _permission_ids.get(role)
+    if ids is None:
+        ids = _permission_ids[role] = list(Permission.objects.filter(
+            content_type__app_label='practicas', codename__in=PERMISSIONS[role]).values_list('id', flat=True))
+    return ids
+
+
+def invalidate():
+    # Permissions get new ids when the database is flushed or migrated
+    _permission_ids.clear()
+
+
+def grant(role, users):
+    """
+    Give the permissions of the role to many users at once, skipping the ones they already have.
+    Tutors also become staff, so they can manage their projects in the admin. Returns the number
+    of permissions given.
+    """
+    users = list(users)
+    created = 0
+    ids = permission_ids(role)
+    through = User.user_permissions.through
+
+    for chunk in chunks(users):
+        existing = set(through.objects.filter(user__in=[user.pk for user in chunk], permission__in=ids)
+                       .values_list('user_id', 'permission_id'))
+        missing = [through(user_id=user.pk, permission_id=permission_id)
+                   for user in chunk for permission_id in ids if (user.pk, permission_id) not in existing]
+        through.objects.bulk_create(missing)
+        created += len(missing)
+
+    if role == TUTOR:
+        staff = [user for user in users if not user.is_staff]
+        for chunk in chunks(staff):
+            User.objects.filter(pk__in=[user.pk for user in chunk]).update(is_staff=True)
+        for user in staff:
+            user.is_staff = True
+
+    for user in users:
+        # Permissions cached by the authentication backend are stale now
+        for attr in ('_perm_cache', '_user_perm_cache'):
+            user.__dict__.pop(attr, None)
+    return created
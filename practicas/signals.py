@@ -0,0 +1,143 @@
+from datetime import date
+
+from django.contrib.auth.models import User
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete, post_migrate, m2m_changed
+from django.dispatch import receiver
+
+from . import archive, catalog, courses, dashboard, middleware, roles, snapshots
+from .capacity import invalidate
+from .models import Course, Participation, Practice, PracticeManager, Project, RegisteredStudent, Request, \
+    Requirement, Student, Tutor, participations_assigned, requests_pruned, seats_changed, students_registered
+
+
+@receiver(post_save, sender=Requirement)
+@receiver(post_delete, sender=Requirement)
+def requirement_changed(sender, instance, **kwargs):
+    invalidate([instance.project_id])
+
+
+@receiver(post_save, sender=Participation)
+@receiver(post_delete, sender=Participation)
+@receiver(post_save, sender=RegisteredStudent)
+@receiver(post_delete, sender=RegisteredStudent)
+def student_dashboard_changed(sender, instance, **kwargs):
+    reg_student = instance.pk if sender is RegisteredStudent else instance.reg_student_id
+    dashboard.invalidate_activity(students=[reg_student])
+
+
+@receiver(post_save, sender=Request)
+@receiver(post_delete, sender=Request)
+@receiver(post_save, sender=Requirement)
+@receiver(post_delete, sender=Requirement)
+@receiver(requests_pruned)
+@receiver(seats_changed)
+def practice_dashboard_changed(sender, **kwargs):
+    dashboard.invalidate_activity()
+
+
+@receiver(participations_assigned, sender=Participation)
+def participations_dashboard_changed(sender, reg_students, **kwargs):
+    dashboard.invalidate_activity(students=reg_students)
+
+
+@receiver(post_save, sender=Project)
+@receiver(post_delete, sender=Project)
+@receiver(post_save, sender=Practice)
+@receiver(post_delete, sender=Practice)
+@receiver(m2m_changed, sender=Project.practices.through)
+def course_dashboard_changed(sender, instance, **kwargs):
+    dashboard.invalidate(courses=[instance.course_id])
+
+
+@receiver(post_save, sender=Project)
+@receiver(post_delete, sender=Project)
+@receiver(m2m_changed, sender=Project.practices.through)
+def catalog_changed(sender, instance, **kwargs):
+    catalog.invalidate([instance.course_id])
+
+
+@receiver(post_save, sender=Requirement)
+@receiver(post_delete, sender=Requirement)
+@receiver(seats_changed)
+def catalog_requirement_changed(sender, **kwargs):
+    # Students only browse the catalog of their practice in the current course, so only it may be stale
+    course = courses.get_current_course()
+    if course:
+        catalog.invalidate([course.pk])
+
+
+@receiver(post_save, sender=Project)
+@receiver(post_delete, sender=Project)
+def project_snapshot_changed(sender, instance, **kwargs):
+    snapshots.invalidate([instance.pk])
+
+
+@receiver(post_save, sender=Participation)
+@receiver(post_delete, sender=Participation)
+def participation_snapshot_changed(sender, instance, **kwargs):
+    if instance.project_id:
+        snapshots.invalidate([instance.project_id])
+
+
+@receiver(participations_assigned, sender=Participation)
+def participations_snapshot_changed(sender, projects, **kwargs):
+    snapshots.invalidate(projects)
+
+
+@receiver(post_save, sender=Project)
+@receiver(post_delete, sender=Project)
+@receiver(m2m_changed, sender=Project.practices.through)
+@receiver(post_save, sender=Tutor)
+@receiver(post_delete, sender=Tutor)
+@receiver(post_save, sender=Course)
+@receiver(post_delete, sender=Course)
+def archive_changed(sender, **kwargs):
+    archive.invalidate()
+
+
+@receiver(post_save, sender=User)
+def archive_user_changed(sender, created, update_fields=None, **kwargs):
+    # Tutors are listed by name; new users and logins change none
+    if not created and not (update_fields and not set(update_fields) & {'first_name', 'last_name'}):
+        archive.invalidate()
+
+
+# Projects whose archived page shows the name of the saved instance
+NAMED_PROJECTS = {
+    User: lambda user: Q(tutor__user=user) | Q(participation__reg_student__student__user=user),
+    Student: lambda student: Q(participation__reg_student__student=student),
+    Tutor: lambda tutor: Q(tutor=tutor),
+    RegisteredStudent: lambda reg_student: Q(participation__reg_student=reg_student),
+}
+
+
+@receiver(post_save, sender=User)
+@receiver(post_save, sender=Student)
+@receiver(post_save, sender=Tutor)
+@receiver(post_save, sender=RegisteredStudent)
+def name_snapshot_changed(sender, instance, created, update_fields=None, **kwargs):
+    # New rows aren't shown anywhere yet, and logins only update last_login
+    if created or update_fields and not set(update_fields) & {'first_name', 'last_name', 'user', 'student'}:
+        return
+    snapshots.invalidate(Project.objects.filter(NAMED_PROJECTS[sender](instance), course__end__lt=date.today())
+                         .values_list('pk', flat=True).distinct())
+
+
+@receiver(post_save)
+@receiver(post_delete)
+@receiver(students_registered)
+def role_changed(sender, **kwargs):
+    if sender in (Course, Practice, PracticeManager, RegisteredStudent):
+        middleware.invalidate()
+
+
+@receiver(post_save, sender=Course)
+@receiver(post_delete, sender=Course)
+def course_changed(sender, **kwargs):
+    courses.invalidate()
+
+
+@receiver(post_migrate)
+def permissions_changed(sender, **kwargs):
+    roles.invalidate()
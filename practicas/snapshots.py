@@ -0,0 +1,27 @@
+import hashlib
+
+from django.core.cache import caches
+
+CACHE_KEY = 'practicas:snapshot:{0}'
+
+
+def _cache():
+    return caches['snapshots']
+
+
+def get(project):
+    """Rendered page and ETag of a project of a finished course, or None if it wasn't rendered yet."""
+    return _cache().get(CACHE_KEY.format(project.pk))
+
+
+def store(project, content):
+    snapshot = {'content': content, 'etag': '"{0}"'.format(hashlib.md5(content).hexdigest())}
+    _cache().set(CACHE_KEY.format(project.pk), snapshot, None)
+    return snapshot
+
+
+def invalidate(project_ids):
+    """Drop the snapshots of the given projects, after their historic data was edited."""
+    keys = [CACHE_KEY.format(project_id) for project_id in project_ids]
+    if keys:
+        _cache().delete_many(keys)
@@ -1 +1,940 @@
-# Create your tests here.
+import csv
+import json
+import time
+from collections import deque
+from datetime import date, timedelta
+from io import BytesIO, StringIO
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.exceptions import ValidationError
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.db.models import Sum
+from django.forms import inlineformset_factory
+from django.template.base import Template
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from . import assignment, capacity, courses, dashboard, jobs, metrics, roles, snapshots
+from .forms import BatchEligibilityFormSet, ParticipationExportForm, ProjectForm, RequirementInlineFormSet
+from .imports import import_students, read_csv
+from .models import *
+
+TEST_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tests'},
+    'snapshots': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tests-snapshots'},
+}
+
+
+def build_practice(students):
+    """
+    A running practice of the current course with ``students`` registered students, a tutor per
+    fifty and a project per ten of them, three requests each and half of them already taking part
+    in a project, plus a project of a finished course. Everything is bulk created, so the biggest
+    scale stays fast.
+    """
+    today = date.today()
+    course = Course.objects.create(start=today - timedelta(100), end=today + timedelta(100))
+    old_course = Course.objects.create(start=today - timedelta(500), end=today - timedelta(200))
+    major = Major.objects.create(name='Ciencia de la Computación', years=5)
+    practice = Practice.objects.create(course=course, major=major, year=3,
+                                       start=today - timedelta(10), end=today + timedelta(10))
+    workplace = Workplace.objects.create(name='Facultad', address='Calle 1', phone=5555)
+    password = make_password('secret')
+
+    def create_users(prefix, count, **kwargs):
+        User.objects.bulk_create(User(username='{0}{1}'.format(prefix, i), password=password, first_name=prefix,
+                                      last_name=str(i), **kwargs) for i in range(count))
+        return list(User.objects.filter(username__startswith=prefix).order_by('id'))
+
+    tutor_users = create_users('tutor', max(1, students // 50), is_staff=True)
+    roles.grant(roles.TUTOR, tutor_users)
+    Tutor.objects.bulk_create(Tutor(user=user, workplace=workplace, job='Profesor', category=Tutor.DOCTOR)
+                              for user in tutor_users)
+    tutor_user = tutor_users[0]
+    tutor = Tutor.objects.get(user=tutor_user)
+    manager_user = create_users('manager', 1)[0]
+    roles.grant(roles.MANAGER, [manager_user])
+    PracticeManager.objects.bulk_create([PracticeManager(user=manager_user, practice=practice)])
+    admin_user = User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+
+    project_count = max(5, students // 10)
+    Project.objects.bulk_create(Project(tutor=tutor, course=course, name='Proyecto {0}'.format(i),
+                                        slug='proyecto-{0}'.format(i), description='Descripción')
+                                for i in range(project_count))
+    projects = list(Project.objects.filter(course=course).order_by('id'))
+    Project.practices.through.objects.bulk_create(
+        Project.practices.through(project_id=project.id, practice_id=practice.id) for project in projects)
+    Requirement.objects.bulk_create(Requirement(project=project, major=major, year=2, students_count=10,
+                                                capacity=15) for project in projects)
+    old_project = Project.objects.create(tutor=tutor, course=old_course, name='Proyecto antiguo',
+                                         description='Descripción')
+
+    student_users = create_users('student', students)
+    roles.grant(roles.STUDENT, student_users)
+    Student.objects.bulk_create(Student(user=user) for user in student_users)
+    reg_students = [RegisteredStudent(student=student, practice=practice, course=course, group='C{0}'.format(i % 4))
+                    for i, student in enumerate(Student.objects.order_by('id'))]
+    RegisteredStudent.objects.bulk_create(reg_students)
+    reg_students = list(RegisteredStudent.objects.order_by('id'))
+    Request.objects.bulk_create(Request(reg_student=reg_student, project=projects[(i + k) % project_count],
+                                        priority=k, checked=k == 0)
+                                for i, reg_student in enumerate(reg_students) for k in range(3))
+    Participation.objects.bulk_create(Participation(reg_student=reg_student, project=projects[i % project_count],
+                                                    proposed_grade=4)
+                                      for i, reg_student in enumerate(reg_students[::2]))
+
+    return {
+        'practice': practice,
+        'projects': projects,
+        'old_project': old_project,
+        'reg_students': reg_students,
+        'tutor': tutor_user,
+        'manager': manager_user,
+        'admin': admin_user,
+    }
+
+
+def formset_post_data(formset):
+    """POST data submitting the formset unchanged, as the browser would."""
+    data = {}
+    for form in [formset.management_form] + list(formset):
+        for name in form.fields:
+            value = form[name].value()
+            data[form[name].html_name] = '' if value is None else value
+    return data
+
+
+class QueryCountTests(object):
+    """
+    Every page must run the same number of queries whatever the size of the practice, so an N+1
+    query shows up as a failure in the bigger scales. Caches are emptied before each test, so the
+    numbers are those of a cold request.
+    """
+    students = None
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.data = build_practice(cls.students)
+        cls.project = cls.data['projects'][0]
+        cls.reg_student = cls.data['reg_students'][0]
+
+    def setUp(self):
+        courses.invalidate()
+        for alias in TEST_CACHES:
+            caches[alias].clear()
+
+    def login(self, user):
+        self.client.force_login(user)
+
+    def assertQueries(self, num, url, method='get', data=None, status=200):
+        # Content types are cached by whichever request asks first
+        ContentType.objects.clear_cache()
+        with self.assertNumQueries(num):
+            response = getattr(self.client, method)(url, data)
+            if response.streaming:
+                b''.join(response.streaming_content)
+        self.assertEqual(response.status_code, status)
+        return response
+
+    # Students
+
+    def test_index_student(self):
+        self.login(self.reg_student.student.user)
+        self.assertQueries(9, reverse('index'))
+
+    def test_index_student_cached(self):
+        self.login(self.reg_student.student.user)
+        self.client.get(reverse('index'))
+        other = Participation.objects.exclude(reg_student=self.reg_student)[0]
+        other.grade = 5
+        other.save()
+        self.assertQueries(4, reverse('index'))
+        participation = Participation.objects.get(reg_student=self.reg_student)
+        participation.grade = 5
+        participation.save()
+        self.assertQueries(6, reverse('index'))
+
+    def test_projects_available(self):
+        self.login(self.reg_student.student.user)
+        self.assertQueries(9, reverse('projects-available'))
+
+    def test_projects_available_cached(self):
+        self.login(self.reg_student.student.user)
+        self.client.get(reverse('projects-available'))
+        # Projects of other courses don't drop the catalog of the practice
+        self.data['old_project'].save()
+        self.assertQueries(5, reverse('projects-available'))
+        self.project.save()
+        self.assertQueries(6, reverse('projects-available'))
+
+    def test_project_detail(self):
+        self.login(self.reg_student.student.user)
+        self.assertQueries(13, reverse('project-detail', args=[self.data['projects'][-1].slug]))
+
+    def test_project_detail_post(self):
+        self.login(self.reg_student.student.user)
+        self.assertQueries(9, reverse('project-detail', args=[self.data['projects'][-1].slug]), 'post',
+                           {'priority': 5}, status=301)
+
+    def test_request_remove(self):
+        self.login(self.reg_student.student.user)
+        request = Request.objects.filter(reg_student=self.reg_student, checked=False).select_related('project')[0]
+        self.assertQueries(10, reverse('request-remove', args=[request.project.slug]), status=301)
+
+    def test_upload_report(self):
+        self.login(self.reg_student.student.user)
+        self.assertQueries(13, reverse('upload-report'))
+
+    def test_student_and_manager(self):
+        user = self.reg_student.student.user
+        roles.grant(roles.MANAGER, [user])
+        PracticeManager.objects.create(user=user, practice=self.data['practice'])
+        self.login(user)
+        response = self.client.get(reverse('index'))
+        self.assertEqual(len(response.context['manager_projects']), len(self.data['projects']))
+        self.assertEqual(self.client.get(reverse('projects-assign')).status_code, 200)
+        self.assertEqual(self.client.get(reverse('projects-available')).status_code, 200)
+
+    def test_role_not_cached_without_role(self):
+        user = self.data['tutor']
+        roles.grant(roles.MANAGER, [user])
+        self.login(user)
+        self.client.get(reverse('index'))
+        # Bulk writes send no post_save, so nothing would drop a cached missing role
+        PracticeManager.objects.bulk_create([PracticeManager(user=user, practice=self.data['practice'])])
+        self.assertEqual(self.client.get(reverse('projects-assign')).status_code, 200)
+
+    # Practice managers
+
+    def test_index_manager(self):
+        self.login(self.data['manager'])
+        self.assertQueries(9, reverse('index'))
+
+    def test_manager_projects(self):
+        practice = self.data['practice']
+        with self.assertNumQueries(1):
+            projects = dashboard.manager_projects(practice)
+        # Projects with several requests and participations, whose seats are joined once per each
+        self.assertTrue(any(project.requested > 1 and project.assigned and project.students_count
+                            for project in projects))
+        for project in projects:
+            seats = Requirement.objects.filter(project=project).aggregate(Sum('students_count'))
+            self.assertEqual((project.requested, project.assigned, project.students_count), (
+                Request.objects.filter(project=project, reg_student__practice=practice).count(),
+                Participation.objects.filter(project=project, reg_student__practice=practice).count(),
+                seats['students_count__sum']))
+
+    def test_assign_projects(self):
+        self.login(self.data['manager'])
+        self.assertQueries(9, reverse('projects-assign'))
+
+    def test_assign_projects_post(self):
+        self.login(self.data['manager'])
+        response = self.client.get(reverse('projects-assign'))
+        data = formset_post_data(response.context['formset'])
+        unassigned = response.context['formset'][1]
+        data[unassigned['project'].html_name] = self.project.pk
+        self.assertQueries(16, reverse('projects-assign'), 'post', data, status=301)
+        self.assertEqual(Participation.objects.get(reg_student=unassigned.instance).project, self.project)
+
+    def test_assign_projects_ineligible(self):
+        self.login(self.data['manager'])
+        response = self.client.get(reverse('projects-assign'))
+        data = formset_post_data(response.context['formset'])
+        unassigned = response.context['formset'][1]
+        data[unassigned['project'].html_name] = self.project.pk
+        Requirement.objects.filter(project=self.project).update(year=4)
+        participations = list(Participation.objects.values_list('reg_student', 'project').order_by('pk'))
+        response = self.client.post(reverse('projects-assign'), data)
+        self.assertEqual(response.context['formset'][1].errors, {'project': [INELIGIBLE_MESSAGE]})
+        self.assertEqual(list(Participation.objects.values_list('reg_student', 'project').order_by('pk')),
+                         participations)
+
+    def test_auto_assign_projects(self):
+        self.login(self.data['manager'])
+        with mock.patch('practicas.views.enqueue_assignment') as enqueue:
+            self.assertQueries(7, reverse('projects-auto_assign'), status=302)
+        enqueue.assert_called_once_with(self.data['practice'])
+
+    def test_auto_assign_status(self):
+        self.login(self.data['manager'])
+        self.assertQueries(7, reverse('projects-auto_assign-status', args=['0' * 32]), status=404)
+
+    def test_requests_list(self):
+        self.login(self.data['manager'])
+        self.assertQueries(7, reverse('requests-list'))
+
+    def test_requests_export(self):
+        self.login(self.data['manager'])
+        self.assertQueries(9, reverse('requests-export'))
+        response = self.client.get(reverse('requests-export'))
+        rows = list(csv.reader(b''.join(response.streaming_content).decode('utf-8').splitlines()))
+        requests = Request.objects.filter(project__practices=self.data['practice'])
+        self.assertEqual(len(rows), requests.count() + 1)
+        self.assertIn(rows[1][-1], ('True', 'False'))
+
+    def test_participations_export(self):
+        self.login(self.data['manager'])
+        response = self.assertQueries(8, reverse('participations-export'))
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        response = self.client.get(reverse('participations-export'), {'format': 'json'})
+        rows = json.loads(b''.join(response.streaming_content).decode('utf-8'))
+        self.assertEqual(len(rows), Participation.objects.filter(reg_student__practice=self.data['practice']).count())
+        self.assertEqual(set(rows[0]), {'username', 'first_name', 'last_name', 'course', 'major', 'year', 'group',
+                                        'project', 'tutor', 'proposed_grade', 'grade', 'report', 'tutor_report'})
+
+    def test_participations_export_admin(self):
+        self.login(self.data['admin'])
+        self.assertQueries(4, reverse('participations-export'), data={'course': self.data['practice'].course_id})
+        self.assertQueries(3, reverse('participations-export'), data={'practice': 0}, status=400)
+
+    # Tutors
+
+    def test_index_tutor(self):
+        self.login(self.data['tutor'])
+        self.assertQueries(8, reverse('index'))
+
+    def test_evaluate_participations(self):
+        self.login(self.data['tutor'])
+        self.assertQueries(7, reverse('participations-evaluate', args=[self.project.slug]))
+
+    def test_evaluate_participations_post(self):
+        self.login(self.data['tutor'])
+        url = reverse('participations-evaluate', args=[self.project.slug])
+        tuples = self.client.get(url).context['tuples']
+        data = {form['proposed_grade'].html_name: 5 for form, participation in tuples}
+        self.assertQueries(10, url, 'post', data, status=301)
+
+    # Archive
+
+    def test_archive_projects(self):
+        self.login(self.data['manager'])
+        self.assertQueries(5, reverse('archive-projects'))
+
+    def test_archive_projects_cached(self):
+        self.login(self.data['manager'])
+        self.client.get(reverse('archive-projects'))
+        self.assertQueries(4, reverse('archive-projects'))
+        project = Project.objects.get(pk=self.project.pk)
+        project.name = 'Proyecto 0 renombrado'
+        project.save()
+        self.assertContains(self.assertQueries(5, reverse('archive-projects')), 'Proyecto 0 renombrado')
+
+    def test_archive_project_detail(self):
+        self.login(self.data['manager'])
+        self.assertQueries(4, reverse('archive-project-detail', args=[self.project.slug]))
+
+    def test_archive_project_detail_closed(self):
+        self.login(self.data['manager'])
+        url = reverse('archive-project-detail', args=[self.data['old_project'].slug])
+        self.assertQueries(4, url)
+        self.assertQueries(3, url)
+        # Renaming the tutor renders the page again
+        tutor = self.data['tutor']
+        tutor.first_name = 'Renombrado'
+        tutor.save()
+        self.assertContains(self.assertQueries(4, url), 'Renombrado')
+        Project.objects.get(pk=self.data['old_project'].pk).delete()
+        self.assertIsNone(snapshots.get(self.data['old_project']))
+
+    # Admin
+
+    def test_admin_changelists(self):
+        self.login(self.data['admin'])
+        for model, num in [('project', 6), ('registeredstudent', 8), ('student', 5), ('tutor', 6),
+                           ('practicemanager', 6), ('practice', 7), ('course', 5), ('major', 6), ('workplace', 5)]:
+            with self.subTest(model=model):
+                self.assertQueries(num, reverse('admin:practicas_{0}_changelist'.format(model)))
+
+    def test_admin_add_forms(self):
+        self.login(self.data['admin'])
+        for model, num in [('project', 27), ('registeredstudent', 32), ('student', 5), ('tutor', 6),
+                           ('practicemanager', 9), ('practice', 7), ('course', 5), ('major', 5), ('workplace', 5)]:
+            with self.subTest(model=model):
+                self.assertQueries(num, reverse('admin:practicas_{0}_add'.format(model)))
+
+    def test_admin_change_forms(self):
+        self.login(self.data['admin'])
+        for model, pk, num in [('project', self.project.pk, 35), ('registeredstudent', self.reg_student.pk, 41),
+                               ('student', self.reg_student.student_id, 7)]:
+            with self.subTest(model=model):
+                self.assertQueries(num, reverse('admin:practicas_{0}_change'.format(model), args=[pk]))
+
+    def test_admin_tutor_projects(self):
+        self.login(self.data['tutor'])
+        self.assertQueries(9, reverse('admin:practicas_project_changelist'))
+        self.assertQueries(12, reverse('admin:practicas_project_add'))
+
+    def test_no_current_course(self):
+        Course.objects.filter(pk=self.data['practice'].course_id).update(end=date.today() - timedelta(1))
+        courses.invalidate()
+        self.login(self.data['tutor'])
+        self.assertEqual(self.client.get(reverse('admin:practicas_project_add')).status_code, 403)
+        with self.assertRaises(Course.DoesNotExist):
+            courses.require_current_course()
+        self.login(self.data['admin'])
+        response = self.client.get(reverse('admin:practicas_practicemanager_add'))
+        self.assertFalse(response.context['adminform'].form.fields['practice'].queryset.exists())
+        self.assertEqual(ProjectForm().fields['practices'].queryset.count(), 0)
+        form = ParticipationExportForm({})
+        self.assertTrue(form.is_valid())
+        self.assertFalse(form.filter(Participation.objects.all()).exists())
+
+    # Requirements
+
+    def test_requirement_delete(self):
+        requirement = Requirement.objects.get(project=self.project)
+        with self.assertNumQueries(7):
+            requirement.delete()
+        self.assertFalse(Request.objects.filter(project=self.project).exists())
+
+    def test_requirements_delete(self):
+        projects = self.data['projects'][:3]
+        major = self.data['practice'].major
+        # Students are in third year: the first project stays open to them, the second doesn't
+        Requirement.objects.create(project=projects[0], major=major, year=3, students_count=5)
+        Requirement.objects.create(project=projects[1], major=major, year=4, students_count=5)
+        requests = Request.objects.filter(project=projects[0]).count()
+        with self.assertNumQueries(8):
+            Requirement.objects.filter(project__in=projects, year=2).delete()
+        self.assertEqual(Request.objects.filter(project__in=projects).count(), requests)
+
+    def test_requirement_inline_delete(self):
+        RequirementFormSet = inlineformset_factory(Project, Requirement, formset=RequirementInlineFormSet,
+                                                   fields=('major', 'year', 'students_count'), extra=0)
+        Requirement.objects.create(project=self.project, major=self.data['practice'].major, year=3,
+                                   students_count=5)
+        data = formset_post_data(RequirementFormSet(instance=self.project))
+        data['requirement_set-0-DELETE'] = data['requirement_set-1-DELETE'] = 'on'
+        formset = RequirementFormSet(data, instance=self.project)
+        self.assertTrue(formset.is_valid())
+        with self.assertNumQueries(8):
+            formset.save()
+        self.assertFalse(Requirement.objects.filter(project=self.project).exists())
+        self.assertFalse(Request.objects.filter(project=self.project).exists())
+
+    # Eligibility
+
+    def test_eligibility(self):
+        reg_student = self.reg_student
+        with self.assertNumQueries(1):
+            Request(reg_student=reg_student, project=self.project).clean()
+        Requirement.objects.filter(project=self.project).update(year=4)
+        with self.assertNumQueries(1), self.assertRaisesMessage(ValidationError, INELIGIBLE_MESSAGE):
+            Participation(reg_student=reg_student, project=self.project).clean()
+        with self.assertRaisesMessage(ValidationError, INELIGIBLE_MESSAGE):
+            Request(reg_student=reg_student, project=self.data['old_project']).clean()
+
+    def test_ineligible_pairs(self):
+        projects = self.data['projects']
+        Requirement.objects.filter(project=projects[1]).update(year=4)
+        pairs = [(reg_student.pk, project.pk) for reg_student in self.data['reg_students']
+                 for project in projects[:2] + [self.data['old_project']]]
+        with self.assertNumQueries(-(-len(self.data['reg_students']) // 500)):
+            ineligible = ineligible_pairs(pairs)
+        self.assertEqual(ineligible, {pair for pair in pairs if pair[1] != projects[0].pk})
+
+    def test_eligibility_formset(self):
+        RequestFormSet = inlineformset_factory(Project, Request, formset=BatchEligibilityFormSet,
+                                               fields=('reg_student', 'priority', 'checked'), extra=0)
+        data = formset_post_data(RequestFormSet(instance=self.project))
+        Requirement.objects.filter(project=self.project).update(year=4)
+        formset = RequestFormSet(data, instance=self.project)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertFalse(formset.is_valid())
+        self.assertEqual(sum('practicas_requirement' in query['sql'] for query in queries), 1)
+        self.assertTrue(formset.forms)
+        self.assertTrue(all(form.non_field_errors() == [INELIGIBLE_MESSAGE] for form in formset.forms))
+
+
+@override_settings(CACHES=TEST_CACHES)
+class TenStudentsQueryCountTests(QueryCountTests, TestCase):
+    students = 10
+
+
+@override_settings(CACHES=TEST_CACHES)
+class HundredStudentsQueryCountTests(QueryCountTests, TestCase):
+    students = 100
+
+
+@override_settings(CACHES=TEST_CACHES)
+class ThousandStudentsQueryCountTests(QueryCountTests, TestCase):
+    students = 1000
+
+
+class RoleTests(TestCase):
+
+    def setUp(self):
+        self.workplace = Workplace.objects.create(name='Facultad', address='Calle 1', phone=5555)
+
+    def test_tutor_save(self):
+        user = User.objects.create_user('tutor', password='secret')
+        with self.assertNumQueries(5):
+            Tutor.objects.create(user=user, workplace=self.workplace, job='Profesor', category=Tutor.DOCTOR)
+        user = User.objects.get(pk=user.pk)
+        self.assertTrue(user.is_staff)
+        self.assertTrue(user.has_perms(['practicas.tutor_permissions', 'practicas.add_project',
+                                        'practicas.change_request', 'practicas.delete_requirement']))
+
+    def test_student_and_manager_save(self):
+        student_user = User.objects.create_user('estudiante', password='secret')
+        Student.objects.create(user=student_user)
+        self.assertTrue(User.objects.get(pk=student_user.pk).has_perm('practicas.student_permissions'))
+        self.assertFalse(User.objects.get(pk=student_user.pk).is_staff)
+
+        today = date.today()
+        course = Course.objects.create(start=today - timedelta(100), end=today + timedelta(100))
+        major = Major.objects.create(name='Ciencia de la Computación', years=5)
+        practice = Practice.objects.create(course=course, major=major, year=3,
+                                           start=today - timedelta(10), end=today + timedelta(10))
+        manager_user = User.objects.create_user('jefe', password='secret')
+        PracticeManager.objects.create(user=manager_user, practice=practice)
+        self.assertTrue(User.objects.get(pk=manager_user.pk).has_perm('practicas.manager_permissions'))
+
+    def test_grant_in_bulk(self):
+        User.objects.bulk_create(User(username='tutor{0}'.format(i)) for i in range(600))
+        users = list(User.objects.order_by('id'))
+        self.assertEqual(roles.grant(roles.TUTOR, users[:10]), 10 * len(roles.PERMISSIONS[roles.TUTOR]))
+
+        # Existing permissions are skipped
+        self.assertEqual(roles.grant(roles.TUTOR, users), 590 * len(roles.PERMISSIONS[roles.TUTOR]))
+        self.assertEqual(User.objects.filter(is_staff=True).count(), 600)
+        self.assertTrue(all(user.is_staff for user in users))
+        self.assertTrue(users[-1].has_perm('practicas.change_participation'))
+
+
+class ImportTests(TestCase):
+    HEADER = 'Usuario;Nombre;Apellidos;Email;Contraseña;Carrera;Año;Grupo\n'
+
+    @classmethod
+    def setUpTestData(cls):
+        today = date.today()
+        cls.course = Course.objects.create(start=today - timedelta(100), end=today + timedelta(100))
+        major = Major.objects.create(name='Ciencia de la Computación', years=5)
+        cls.practice = Practice.objects.create(course=cls.course, major=major, year=3,
+                                               start=today - timedelta(10), end=today + timedelta(10))
+        old_course = Course.objects.create(start=today - timedelta(500), end=today - timedelta(200))
+        old_practice = Practice.objects.create(course=old_course, major=major, year=2,
+                                               start=today - timedelta(450), end=today - timedelta(440))
+        cls.returning = Student.objects.create(user=User.objects.create_user('antiguo', password='secret'))
+        RegisteredStudent.objects.create(student=cls.returning, practice=old_practice, group='C1')
+        User.objects.create_user('profesor', password='secret')
+
+    def read(self, text):
+        return read_csv(BytesIO(text.encode('utf-8')))
+
+    def test_import(self):
+        rows = self.read(self.HEADER +
+                         'ana;Ana;Pérez;ana@example.com;clave1;Ciencia de la Computación;3;C311\n'
+                         'luis;Luis;Díaz;luis@example.com;;ciencia de la computación;3.0;C312\n'
+                         'antiguo;;;;;Ciencia de la Computación;3;C311\n'
+                         '\n'
+                         'ana;Ana;Pérez;ana@example.com;clave1;Ciencia de la Computación;3;C311\n'
+                         'pedro;Pedro;Gómez;pedro@example.com;clave;Ciencia de la Computación;4;C411\n'
+                         'marta;Marta;Ruiz;;clave;Ciencia de la Computación;3;C311\n'
+                         'profesor;;;;;Ciencia de la Computación;3;C311\n'
+                         'mal usuario!;Mal;Usuario;mal@example.com;clave;Ciencia de la Computación;tres;\n')
+        result = import_students(rows, self.course, 'comun', chunk_size=2, workers=1)
+
+        self.assertEqual((result.users, result.registered), (2, 3))
+        self.assertEqual([line for line, message in result.errors], [6, 7, 8, 9, 10])
+        self.assertIn('ya está registrado', result.errors[0][1])
+        self.assertIn('No existe una práctica', result.errors[1][1])
+        self.assertIn('Email', result.errors[2][1])
+        self.assertIn('no es un estudiante', result.errors[3][1])
+
+        ana = User.objects.get(username='ana')
+        self.assertTrue(ana.check_password('clave1'))
+        self.assertTrue(ana.has_perm('practicas.student_permissions'))
+        self.assertTrue(User.objects.get(username='luis').check_password('comun'))
+        self.assertEqual(set(RegisteredStudent.objects.filter(practice=self.practice)
+                             .values_list('student__user__username', 'course', 'group')),
+                         {('ana', self.course.pk, 'C311'), ('luis', self.course.pk, 'C312'),
+                          ('antiguo', self.course.pk, 'C311')})
+        self.assertEqual(Student.objects.filter(user__username='antiguo').count(), 1)
+
+    def test_password_pool(self):
+        rows = self.read(self.HEADER + ''.join(
+            'e{0};E;{0};e{0}@example.com;clave{0};Ciencia de la Computación;3;C31\n'.format(i) for i in range(6)))
+        result = import_students(rows, self.course, workers=2)
+        self.assertEqual((result.users, result.registered, result.errors), (6, 6, []))
+        self.assertTrue(User.objects.get(username='e5').check_password('clave5'))
+
+    def test_missing_columns(self):
+        with self.assertRaisesMessage(ValueError, 'Faltan las columnas Año, Grupo.'):
+            import_students(self.read('Usuario,Carrera\nana,Ciencia de la Computación\n'), self.course)
+
+    def test_command(self):
+        out = StringIO()
+        with mock.patch('practicas.management.commands.import_students.open',
+                        return_value=BytesIO((self.HEADER + 'ana;Ana;Pérez;ana@example.com;clave;'
+                                              'Ciencia de la Computación;3;C311\n').encode('utf-8')), create=True):
+            call_command('import_students', 'estudiantes.csv', '--course', str(self.course), '--workers', '1',
+                         stdout=out)
+        self.assertIn('1 estudiante(s) registrado(s), 1 usuario(s) nuevo(s).', out.getvalue())
+
+    def test_admin(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.login(username='admin', password='secret')
+        url = reverse('admin:practicas_registeredstudent_import')
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+        upload = SimpleUploadedFile('estudiantes.csv', (self.HEADER + 'ana;Ana;Pérez;ana@example.com;;'
+                                                        'Ciencia de la Computación;3;C311\n').encode('utf-8'))
+        with self.settings(IMPORT_HASH_WORKERS=1):
+            response = self.client.post(url, {'file': upload, 'course': self.course.pk, 'password': 'comun'})
+        self.assertContains(response, '1 estudiante(s) registrado(s)')
+        self.assertTrue(User.objects.get(username='ana').check_password('comun'))
+
+
+@override_settings(CACHES=TEST_CACHES)
+class AssignmentTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        today = date.today()
+        course = Course.objects.create(start=today - timedelta(100), end=today + timedelta(100))
+        cls.major = Major.objects.create(name='Ciencia de la Computación', years=5)
+        cls.practice = Practice.objects.create(course=course, major=cls.major, year=3,
+                                               start=today - timedelta(10), end=today + timedelta(10))
+        workplace = Workplace.objects.create(name='Facultad', address='Calle 1', phone=5555)
+        tutor = Tutor.objects.create(user=User.objects.create_user('tutor', password='secret'), workplace=workplace,
+                                     job='Profesor', category=Tutor.DOCTOR)
+        cls.projects = []
+        for i in range(3):
+            project = Project.objects.create(tutor=tutor, course=course, name='Proyecto {0}'.format(i),
+                                             description='Descripción')
+            project.practices.add(cls.practice)
+            cls.projects.append(project)
+        cls.students = []
+        for i in range(4):
+            student = Student.objects.create(user=User.objects.create_user('student{0}'.format(i), password='secret'))
+            cls.students.append(RegisteredStudent.objects.create(student=student, practice=cls.practice, course=course,
+                                                                 group='C31'))
+
+    def setUp(self):
+        assignment._solutions.clear()
+
+    def seats(self, project, count, year=2):
+        return Requirement.objects.create(project=project, major=self.major, year=year, students_count=count)
+
+    def request(self, reg_student, *projects, checked=False):
+        for priority, project in enumerate(projects):
+            Request.objects.create(reg_student=reg_student, project=project, priority=priority,
+                                   checked=checked and priority == 0)
+
+    def test_reassign_sees_taken_seats(self):
+        first, second = self.projects[:2]
+        self.seats(first, 1)
+        self.seats(second, 1)
+        self.request(self.students[1], first, second)
+        problem, result = assignment.reassign(self.practice)
+        self.assertEqual(result.projects, {self.students[1].pk: first.pk})
+
+        # The seat is taken outside of any assignment, and a seat of the other project through a bare update
+        Participation.objects.create(reg_student=self.students[0], project=first)
+        problem, result = assignment.reassign(self.practice)
+        self.assertEqual(result.projects, {self.students[1].pk: second.pk})
+        Requirement.objects.filter(project=second).update(students_count=0)
+        self.request(self.students[2], first)
+        problem, result = assignment.reassign(self.practice)
+        self.assertEqual(result.projects, {})
+        self.assertEqual(result.unassigned, [self.students[1].pk, self.students[2].pk])
+
+    def test_seat_changes_notify(self):
+        project = self.projects[0]
+        requirement = self.seats(project, 2)
+        self.assertEqual(capacity.remaining_seats(project.pk, self.major.pk, 3), 2)
+        with self.assertNumQueries(0):
+            capacity.remaining_seats(project.pk, self.major.pk, 3)
+
+        handler = mock.Mock()
+        seats_changed.connect(handler)
+        self.addCleanup(seats_changed.disconnect, handler)
+        participation = Participation.objects.create(reg_student=self.students[0], project=project)
+        self.assertEqual(capacity.remaining_seats(project.pk, self.major.pk, 3), 1)
+        participation.delete()
+        self.assertEqual(capacity.remaining_seats(project.pk, self.major.pk, 3), 2)
+        Requirement.objects.filter(pk=requirement.pk).update(students_count=0)
+        self.assertEqual(capacity.reconcile(fix=True), [(requirement.pk, 0, 2)])
+        self.assertEqual([call[1]['projects'] for call in handler.call_args_list], [[project.pk]] * 3)
+
+    def test_solve_optimal(self):
+        first, second, third = self.projects
+        for project in self.projects:
+            self.seats(project, 1)
+        # Giving the first student its first choice would leave the second one without a project
+        self.request(self.students[0], first, second)
+        self.request(self.students[1], first)
+        self.request(self.students[2], second, third)
+        result = assignment.solve(assignment.load_problem(self.practice), seed=1)
+        self.assertEqual(result.projects, {self.students[0].pk: second.pk, self.students[1].pk: first.pk,
+                                           self.students[2].pk: third.pk})
+        self.assertEqual(result.ranks, {self.students[0].pk: 1, self.students[1].pk: 0, self.students[2].pk: 1})
+        self.assertEqual(result.unassigned, [])
+
+    def test_solve_capacity_by_major_and_year(self):
+        first, second, third = self.projects
+        self.seats(first, 1, year=2)
+        self.seats(first, 1, year=3)
+        # Seats for fourth year students or for another major are not for this practice
+        self.seats(second, 5, year=4)
+        other = Major.objects.create(name='Matemática', years=5)
+        Requirement.objects.create(project=third, major=other, year=1, students_count=5)
+        for reg_student in self.students[:3]:
+            self.request(reg_student, first, second, third)
+
+        problem = assignment.load_problem(self.practice)
+        self.assertEqual((problem.capacity(first.pk), problem.capacity(second.pk), problem.capacity(third.pk)),
+                         (2, 0, 0))
+        result = assignment.solve(problem)
+        self.assertEqual(sorted(result.projects.values()), [first.pk, first.pk])
+        self.assertEqual(len(result.unassigned), 1)
+
+    def test_solve_unassigned(self):
+        first = self.projects[0]
+        self.seats(first, 1)
+        self.request(self.students[0], first, checked=True)
+        self.request(self.students[1], first)
+        self.request(self.students[2], self.projects[1])
+        result = assignment.solve(assignment.load_problem(self.practice))
+        # Checked requests are honoured first; the project without requirements has no seats
+        self.assertEqual(result.projects, {self.students[0].pk: first.pk})
+        self.assertEqual(result.unassigned, [self.students[1].pk, self.students[2].pk])
+
+    def test_save_assignment(self):
+        first, second = self.projects[:2]
+        first_seats = self.seats(first, 2)
+        second_seats = self.seats(second, 2)
+        Participation.objects.create(reg_student=self.students[0], project=first)
+        self.request(self.students[1], second)
+
+        problem = assignment.load_problem(self.practice)
+        result = assignment.solve(problem)
+        # The participation of the first student is moved, not duplicated
+        result.projects[self.students[0].pk] = second.pk
+        result.ranks[self.students[0].pk] = 0
+        assignment.save_assignment(problem, result)
+
+        self.assertEqual(dict(Participation.objects.filter(reg_student__in=self.students)
+                              .values_list('reg_student', 'project')),
+                         {self.students[0].pk: second.pk, self.students[1].pk: second.pk})
+        first_seats.refresh_from_db()
+        second_seats.refresh_from_db()
+        self.assertEqual((first_seats.students_count, second_seats.students_count), (2, 0))
+        self.assertEqual(problem.assigned, {self.students[0].pk: second.pk, self.students[1].pk: second.pk})
+
+    def test_simulate(self):
+        first, second, third = self.projects
+        for project in self.projects:
+            self.seats(project, 1)
+        self.request(self.students[0], first, second)
+        self.request(self.students[1], first, third)
+        self.request(self.students[2], first)
+        self.request(self.students[3], second)
+        problem = assignment.load_problem(self.practice)
+
+        with self.assertNumQueries(0):
+            simulations = assignment.simulate(problem, range(4), processes=2)
+        self.assertEqual(len(simulations), 4)
+        self.assertFalse(Participation.objects.exists())
+        best = simulations[0]
+        self.assertEqual((best.statistics['assigned'], best.statistics['cost']),
+                         (3, assignment.solve(problem).cost))
+
+        assignment.save_assignment(problem, best.assignment)
+        self.assertEqual(dict(Participation.objects.values_list('reg_student', 'project')), best.assignment.projects)
+        self.assertEqual(dict(Requirement.objects.filter(students_count__gt=0).values_list('id', 'students_count')),
+                         best.statistics['under_filled'])
+
+    def test_plan_seats(self):
+        # Two requirements of the same project: third year students fill the third year one first
+        requirements = [(1, 10, 7, 3, 2, 2), (2, 10, 7, 2, 1, 1)]
+        move = (None, 10, 7, 3)
+        self.assertEqual(capacity.plan_seats(requirements, [move]), {1: -1})
+        self.assertEqual(capacity.plan_seats(requirements, [move] * 3), {1: -2, 2: -1})
+        # Beyond the capacity students still move in, but take no seat
+        self.assertEqual(capacity.plan_seats(requirements, [move] * 4), {1: -2, 2: -1})
+        # Second year students only fit the second year requirement, and leaving gives the seat back
+        self.assertEqual(capacity.plan_seats(requirements, [(None, 10, 7, 2)] * 2), {2: -1})
+        self.assertEqual(capacity.plan_seats(requirements, [move, (10, None, 7, 3)]), {})
+        self.assertEqual(capacity.plan_seats([(1, 10, 7, 3, 0, 2)], [(10, 11, 7, 3)]), {1: 1})
+        # Unless the project holds more students of the major than seats, so the one leaving had none
+        self.assertEqual(capacity.plan_seats([(1, 10, 7, 3, 0, 2)], [(10, None, 7, 3)], {(10, 7): 3}), {})
+        self.assertEqual(capacity.plan_seats([(1, 10, 7, 3, 0, 2)], [(10, None, 7, 3)] * 2, {(10, 7): 3}), {1: 1})
+        # Students of another major beyond their own seats don't hold this major's seats
+        requirements = [(1, 10, 7, 3, 0, 1), (2, 10, 8, 3, 0, 1)]
+        self.assertEqual(capacity.plan_seats(requirements, [(10, None, 7, 3)], {(10, 7): 1, (10, 8): 2}), {1: 1})
+
+    def test_bulk_assign(self):
+        first, second = self.projects[:2]
+        first_seats = self.seats(first, 2)
+        second_seats = self.seats(second, 2)
+        for reg_student in self.students:
+            self.request(reg_student, first, second)
+        assignment.reassign(self.practice)
+        self.assertEqual(capacity.remaining_seats(first.pk, self.major.pk, 3), 2)
+
+        # Over-subscribing the first project
+        Participation.objects.bulk_assign({reg_student.pk: first.pk for reg_student in self.students[:3]})
+        self.assertEqual(Participation.objects.filter(project=first).count(), 3)
+        first_seats.refresh_from_db()
+        self.assertEqual(first_seats.students_count, 0)
+        self.assertEqual(capacity.remaining_seats(first.pk, self.major.pk, 3), 0)
+
+        # A partial fill of the second one, and the remembered solution sees both
+        Participation.objects.bulk_assign({self.students[2].pk: second.pk})
+        first_seats.refresh_from_db()
+        second_seats.refresh_from_db()
+        self.assertEqual((first_seats.students_count, second_seats.students_count), (0, 1))
+        problem, result = assignment.reassign(self.practice)
+        self.assertEqual(result.projects, {self.students[3].pk: second.pk})
+
+        # One at a time too: a third student in the first project takes no seat, so leaving gives none back
+        Participation.objects.create(reg_student=self.students[3], project=first)
+        Participation.objects.get(reg_student=self.students[3]).delete()
+        first_seats.refresh_from_db()
+        self.assertEqual(first_seats.students_count, 0)
+
+    def test_assign_projects_large_practice(self):
+        # More students than the default limit of fields of a request allows for
+        count = 4000
+        User.objects.bulk_create(User(username='many{0}'.format(i)) for i in range(count))
+        Student.objects.bulk_create(Student(user=user) for user in User.objects.filter(username__startswith='many'))
+        RegisteredStudent.objects.bulk_create(
+            RegisteredStudent(student=student, practice=self.practice, course=self.practice.course, group='C32')
+            for student in Student.objects.filter(user__username__startswith='many'))
+        user = User.objects.create_user('manager', password='secret')
+        PracticeManager.objects.create(user=user, practice=self.practice)
+        self.client.force_login(user)
+
+        reg_students = list(RegisteredStudent.objects.filter(practice=self.practice).values_list('pk', flat=True))
+        self.assertGreater(len(reg_students) * 3, 10000)
+        data = {'form-TOTAL_FORMS': len(reg_students), 'form-INITIAL_FORMS': len(reg_students),
+                'form-MIN_NUM_FORMS': 0, 'form-MAX_NUM_FORMS': settings.ASSIGN_MAX_STUDENTS}
+        for i, pk in enumerate(reg_students):
+            data.update({'form-{0}-id'.format(i): pk, 'form-{0}-project'.format(i): '',
+                         'form-{0}-grade'.format(i): ''})
+        data['form-0-project'] = self.projects[0].pk
+        self.seats(self.projects[0], 1)
+        response = self.client.post(reverse('projects-assign'), data)
+        self.assertEqual(response.status_code, 301)
+        self.assertEqual(Participation.objects.get(project=self.projects[0]).reg_student_id, reg_students[0])
+
+    def test_release_seat_by_major(self):
+        project = self.projects[0]
+        first_seats = self.seats(project, 1)
+        major = Major.objects.create(name='Matemática', years=5)
+        practice = Practice.objects.create(course=self.practice.course, major=major, year=3,
+                                           start=self.practice.start - timedelta(1),
+                                           end=self.practice.end + timedelta(1))
+        project.practices.add(practice)
+        Requirement.objects.create(project=project, major=major, year=2, students_count=1)
+        others = []
+        for i in range(2):
+            student = Student.objects.create(user=User.objects.create_user('other{0}'.format(i), password='secret'))
+            others.append(RegisteredStudent.objects.create(student=student, practice=practice,
+                                                           course=self.practice.course, group='C31'))
+
+        # The second student of the other major is beyond its capacity, and holds none of this major's seats
+        Participation.objects.create(reg_student=self.students[0], project=project)
+        for reg_student in others:
+            Participation.objects.create(reg_student=reg_student, project=project)
+        Participation.objects.get(reg_student=self.students[0]).delete()
+        first_seats.refresh_from_db()
+        self.assertEqual(first_seats.students_count, 1)
+        self.assertEqual(capacity.reconcile(), [])
+
+
+@override_settings(CACHES=TEST_CACHES)
+class JobTests(TransactionTestCase):
+    """Jobs run in a worker thread with its own connection, so the data must be committed."""
+
+    def setUp(self):
+        caches['default'].clear()
+        assignment._solutions.clear()
+        today = date.today()
+        course = Course.objects.create(start=today - timedelta(100), end=today + timedelta(100))
+        major = Major.objects.create(name='Ciencia de la Computación', years=5)
+        self.practice = Practice.objects.create(course=course, major=major, year=3,
+                                                start=today - timedelta(10), end=today + timedelta(10))
+        tutor = Tutor.objects.create(user=User.objects.create_user('tutor', password='secret'),
+                                     workplace=Workplace.objects.create(name='Facultad', address='Calle 1', phone=5555),
+                                     job='Profesor', category=Tutor.DOCTOR)
+        self.project = Project.objects.create(tutor=tutor, course=course, name='Proyecto', description='Descripción')
+        self.project.practices.add(self.practice)
+        Requirement.objects.create(project=self.project, major=major, year=2, students_count=1)
+        for i in range(2):
+            student = Student.objects.create(user=User.objects.create_user('student{0}'.format(i), password='secret'))
+            reg_student = RegisteredStudent.objects.create(student=student, practice=self.practice, course=course,
+                                                           group='C31')
+            Request.objects.create(reg_student=reg_student, project=self.project, priority=0)
+
+    def wait(self, job):
+        for _ in range(100):
+            job = jobs.get_job(job.id)
+            if not job.active:
+                return job
+            time.sleep(0.05)
+        self.fail('The job did not finish')
+
+    def test_run(self):
+        job = self.wait(jobs.enqueue_assignment(self.practice))
+
+        self.assertEqual((job.status, job.progress, job.error), (jobs.DONE, 100, None))
+        self.assertEqual(job.summary, {'assigned': 1, 'first_choice': 1, 'unassigned': 1})
+        self.assertEqual(jobs.latest_job(self.practice).id, job.id)
+        self.assertEqual(Participation.objects.filter(project=self.project).count(), 1)
+        self.assertEqual(Requirement.objects.get(project=self.project).students_count, 0)
+
+        # Finished jobs don't block the next one
+        self.assertNotEqual(self.wait(jobs.enqueue_assignment(self.practice)).id, job.id)
+
+    def test_single_active_job(self):
+        with mock.patch.object(jobs._executor, 'submit') as submit:
+            job = jobs.enqueue_assignment(self.practice)
+            self.assertEqual(jobs.enqueue_assignment(self.practice).id, job.id)
+        self.assertEqual(submit.call_count, 1)
+        self.assertEqual(jobs.latest_job(self.practice).status, jobs.PENDING)
+
+
+@override_settings(CACHES=TEST_CACHES, METRICS_QUERIES=True)
+class MetricsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.data = build_practice(10)
+
+    def setUp(self):
+        courses.invalidate()
+        for alias in TEST_CACHES:
+            caches[alias].clear()
+        metrics.reset()
+        self.client.force_login(self.data['manager'])
+        # A log smaller than the queries of a request, as the real one is once it wrapped around
+        log = connection.queries_log
+        self.addCleanup(setattr, connection, 'queries_log', log)
+        connection.queries_log = deque(maxlen=3)
+        # The test environment replaced the timed rendering installed when the app was ready
+        self.addCleanup(setattr, Template, '_render', Template._render)
+        metrics.instrument_templates()
+
+    def test_queries(self):
+        ContentType.objects.clear_cache()
+        self.client.get(reverse('index'))
+        stats = metrics.snapshot()['index']
+        self.assertEqual((stats['count'], stats['queries']['max']), (1, 9))
+        self.assertGreater(stats['template_seconds']['max'], 0)
+        self.assertFalse(connection.force_debug_cursor)
+
+    def test_streaming(self):
+        ContentType.objects.clear_cache()
+        response = self.client.get(reverse('participations-export'))
+        self.assertNotIn('participations-export', metrics.snapshot())
+        b''.join(response.streaming_content)
+        self.assertEqual(metrics.snapshot()['participations-export']['queries']['max'], 8)
@@ -8,16 +8,23 @@ urlpatterns = [
     url(r'^projects/$', views.projects_available, name='projects-available'),
     url(r'^projects/assign/$', views.assign_projects, name='projects-assign'),
     url(r'^projects/auto-assign/$', views.auto_assign_projects, name='projects-auto_assign'),
+    url(r'^projects/auto-assign/(?P<job_id>[0-9a-f]+)/$', views.auto_assign_status, name='projects-auto_assign-status'),
     url(r'^projects/(?P<project_name_slug>[-\w]+)/$', views.project_detail, name='project-detail'),
     url(r'^projects/(?P<project_name_slug>[-\w]+)/remove_request/$', views.request_remove, name='request-remove'),
     url(r'^projects/(?P<project_name_slug>[-\w]+)/evaluate/$', views.evaluate_participations,
         name='participations-evaluate'),
 
     url(r'requests/$', views.RequestsList.as_view(), name='requests-list'),
+    url(r'^requests/export/$', views.export_requests, name='requests-export'),
+
+    url(r'^participations/export/$', views.export_participations, name='participations-export'),
 
     url(r'^upload_report/$', views.upload_report, name='upload-report'),
 
     url(r'^archive/projects/$', views.ProjectArchive.as_view(), name='archive-projects'),
     url(r'^archive/projects/(?P<slug>[-\w]+)/$', views.ArchiveProjectDetailView.as_view(),
-        name='archive-project-detail')
+        name='archive-project-detail'),
+
+    url(r'^metrics/$', views.metrics_report, name='metrics'),
+    url(r'^metrics/prometheus/$', views.metrics_prometheus, name='metrics-prometheus'),
 ]
@@ -1,48 +1,51 @@
+import csv
+from collections import defaultdict
 from datetime import date
+from itertools import chain
 
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required, permission_required
-from django.db.models.aggregates import Sum
-from django.http import HttpResponseForbidden
+from django.db import transaction
+from django.db.models import Q
+from django.http import HttpResponse, HttpResponseForbidden, HttpResponseNotModified, JsonResponse, Http404, \
+    StreamingHttpResponse
 from django.shortcuts import render, get_object_or_404, redirect
+from django.utils.cache import patch_cache_control
 from django.utils.decorators import method_decorator
 from django.views.generic import DetailView, ListView
 
-from practicas.forms import RequestForm, ParticipationAssignForm, ParticipationForm
-from set_participations import set_participations
+from practicas.forms import RequestForm, ProjectArchiveFilterForm, RequestFilterForm, ParticipationAssignFormSet, \
+    ParticipationForm, ParticipationEvaluationForm, ParticipationExportForm
+from . import archive, metrics, snapshots
+from .capacity import remaining_seats
+from .catalog import available_projects, sample_projects
+from .dashboard import get_dashboard
+from .exports import PARTICIPATION_COLUMNS, json_lines, participation_rows, stream_rows
+from .jobs import enqueue_assignment, get_job, latest_job
 from .models import *
 
 
-@login_required
-def index(request):
-    context_dict = {}
+def current_reg_student(request):
+    if request.role.reg_student is None:
+        raise Http404
+    return request.role.reg_student
 
-    try:
-        reg_student = RegisteredStudent.objects.get(student__user=request.user,
-                                                    practice__course__start__lte=date.today(),
-                                                    practice__course__end__gte=date.today())
-        practice = reg_student.practice
 
-    except RegisteredStudent.DoesNotExist:
-        reg_student = None
+def current_manager(request):
+    if request.role.manager is None:
+        raise Http404
+    return request.role.manager
 
-        try:
-            manager = PracticeManager.objects.get(user=request.user, practice__course__start__lte=date.today(),
-                                                  practice__course__end__gte=date.today())
-            practice = manager.practice
-            manager_projects = Project.objects.filter(practices=practice)
-
-            t = []
-            for proj in manager_projects:
-                total = Requirement.objects.filter(project=proj).aggregate(Sum('students_count'))
-                t.append((proj, total['students_count__sum']))
-            context_dict['manager_projects'] = t
 
-        except PracticeManager.DoesNotExist:
-            practice = None
+@login_required
+def index(request):
+    context_dict = {}
 
-    tutor_projects = Project.objects.filter(tutor__user=request.user, practices__start__lte=date.today(),
-                                            practices__end__gte=date.today()).distinct()
-    context_dict['tutor_projects'] = tutor_projects
+    dashboard = get_dashboard(request.user, request.role)
+    reg_student = request.role.reg_student
+    practice = request.role.practice
+    context_dict['manager_projects'] = dashboard['manager_projects']
+    context_dict['tutor_projects'] = dashboard['tutor_projects']
 
     if practice:
         if practice.start <= date.today() <= practice.end:
@@ -52,50 +55,66 @@ def index(request):
             context_dict['days_until'] = (practice.start - date.today()).days
 
             if reg_student:
-                available_projects = Project.objects.filter(practices=practice,
-                                                            requirement__major=practice.major,
-                                                            requirement__year__lte=practice.year).order_by('?')
-                context_dict['available_projects'] = available_projects[:6]
+                context_dict['available_projects'] = sample_projects(practice, 6)
 
         else:
             # Practice is over
             context_dict['days_after'] = (date.today() - practice.end).days
             if reg_student:
                 # Current user is a student
-                grade = Participation.objects.get(reg_student=reg_student).grade
-                context_dict['grade'] = grade
+                context_dict['grade'] = dashboard['grade']
 
     return render(request, 'practicas/index.html', context_dict)
 
 
 @permission_required('practicas.student_permissions')
 def projects_available(request):
-    reg_student = get_object_or_404(RegisteredStudent, student__user=request.user, course__start__lte=date.today(),
-                                    course__end__gte=date.today())
+    reg_student = current_reg_student(request)
     practice = reg_student.practice
 
-    available_projects = Project.objects.filter(practices=practice, requirement__major=practice.major,
-                                                requirement__year__lte=practice.year) \
-        .exclude(request__reg_student=reg_student)
-
-    requested_projects = Request.objects.filter(reg_student=reg_student).order_by('priority')
+    requested_projects = list(Request.objects.filter(reg_student=reg_student).select_related('project')
+                              .order_by('priority'))
+    requested_ids = {req.project_id for req in requested_projects}
+    projects = [project for project in available_projects(practice) if project['id'] not in requested_ids]
 
     return render(request, 'practicas/available_projects.html',
-                  {'available_projects': available_projects, 'requested_projects': requested_projects})
+                  {'available_projects': projects, 'requested_projects': requested_projects})
 
 
 class ArchiveProjectDetailView(DetailView):
     model = Project
     template_name = 'practicas/archive_project_detail.html'
 
+    def get_queryset(self):
+        return Project.objects.select_related('course', 'tutor__user')
+
     def get_context_data(self, **kwargs):
         context = super(ArchiveProjectDetailView, self).get_context_data(**kwargs)
 
-        participations = Participation.objects.filter(project=self.object)
+        participations = Participation.objects.filter(project=self.object).select_related('reg_student__student__user')
         context['participations'] = participations
 
         return context
 
+    def get(self, request, *args, **kwargs):
+        self.object = self.get_object()
+        if self.object.course.end >= date.today():
+            return self.render_to_response(self.get_context_data(object=self.object))
+
+        # Projects of finished courses are rendered once and served from their snapshot afterwards
+        snapshot = snapshots.get(self.object)
+        if snapshot is None:
+            response = self.render_to_response(self.get_context_data(object=self.object))
+            snapshot = snapshots.store(self.object, response.render().content)
+
+        if request.META.get('HTTP_IF_NONE_MATCH') == snapshot['etag']:
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(snapshot['content'])
+        response['ETag'] = snapshot['etag']
+        patch_cache_control(response, private=True, max_age=365 * 24 * 60 * 60)
+        return response
+
     @method_decorator(login_required)
     def dispatch(self, request, *args, **kwargs):
         return super(ArchiveProjectDetailView, self).dispatch(request, *args, **kwargs)
@@ -103,8 +122,7 @@ class ArchiveProjectDetailView(DetailView):
 
 @permission_required('practicas.student_permissions')
 def request_remove(request, project_name_slug):
-    reg_student = get_object_or_404(RegisteredStudent, student__user=request.user, course__start__lte=date.today(),
-                                    course__end__gte=date.today())
+    reg_student = current_reg_student(request)
     practice = reg_student.practice
     project = get_object_or_404(Project, slug=project_name_slug)
 
@@ -123,8 +141,7 @@ def request_remove(request, project_name_slug):
 def project_detail(request, project_name_slug):
     project = get_object_or_404(Project, slug=project_name_slug)
 
-    reg_student = get_object_or_404(RegisteredStudent, student__user=request.user, course__start__lte=date.today(),
-                                    course__end__gte=date.today())
+    reg_student = current_reg_student(request)
     practice = reg_student.practice
 
     # A HTTP POST?
@@ -148,7 +165,8 @@ def project_detail(request, project_name_slug):
         # If the request was not a POST, display the form to enter details.
         form = RequestForm()
 
-    context = {'form': form, 'project': project}
+    context = {'form': form, 'project': project,
+               'remaining_seats': remaining_seats(project.pk, practice.major_id, practice.year)}
 
     try:
         context['request'] = Request.objects.get(project=project, reg_student=reg_student)
@@ -163,59 +181,85 @@ def project_detail(request, project_name_slug):
 class ProjectArchive(ListView):
     model = Project
     template_name = 'practicas/archive_projects.html'
-    ordering = ['-course']
+    paginate_by = 50
+
+    def get_queryset(self):
+        self.filter_form = ProjectArchiveFilterForm(self.request.GET)
+        return self.filter_form.filter(Project.objects.select_related('tutor__user', 'course')) \
+            .order_by('-course__start', 'name', 'id')
+
+    def get_context_data(self, **kwargs):
+        context = super(ProjectArchive, self).get_context_data(**kwargs)
+        query = self.request.GET.copy()
+        query.pop('page', None)
+        context.update({
+            'filter_form': self.filter_form,
+            'filter_query': query.urlencode(),
+            # Every page is cached, the current course's included, until a project, tutor or course changes
+            'cache_timeout': archive.TIMEOUT,
+            'cache_version': archive.version(),
+            'cache_key': query.urlencode(),
+        })
+        return context
 
 
 @permission_required('practicas.tutor_permissions')
 def evaluate_participations(request, project_name_slug):
     project = get_object_or_404(Project, slug=project_name_slug)
-    current_projects = Project.objects.filter(tutor__user=request.user, practices__start__lte=date.today(),
-                                              practices__end__gte=date.today())
-    participations = Participation.objects.filter(project=project)
 
-    if project not in current_projects:
+    is_current_tutor = Project.objects.filter(pk=project.pk, tutor__user=request.user,
+                                              practices__start__lte=date.today(),
+                                              practices__end__gte=date.today()).exists()
+    if not is_current_tutor:
         return HttpResponseForbidden(
             "<h1>Error</h1>Usted no tiene permiso para modificar las participaciones en el proyecto solicitado.")
 
+    participations = list(Participation.objects.filter(project=project)
+                          .select_related('reg_student__student__user')
+                          .order_by('reg_student__group', 'reg_student__student__user__last_name'))
+
     # A HTTP POST?
     if request.method == 'POST':
-        forms = []
-        valid = True
-        for i in range(len(participations)):
-            forms.append(ParticipationForm(request.POST, prefix=str(i), instance=participations[i]))
-            valid = valid and forms[i].is_valid()
+        forms = [ParticipationEvaluationForm(request.POST, request.FILES, prefix=str(i), participation=part)
+                 for i, part in enumerate(participations)]
 
         # Have been provided with valid forms?
-        if valid:
-            for i in range(len(forms)):
-                part = forms[i].save(commit=False)
-                # Did the tutor provide a report?
-                if '{0}-tutor_report'.format(i) in request.FILES:
-                    participations[i].tutor_report.delete()
-                    part.tutor_report = request.FILES['{0}-tutor_report'.format(i)]
-                part.save()
+        if all([form.is_valid() for form in forms]):
+            grades = defaultdict(list)
+            reports = []
+            for form in forms:
+                part = form.participation
+                if form.cleaned_data['proposed_grade'] != part.proposed_grade:
+                    grades[form.cleaned_data['proposed_grade']].append(part.pk)
+                # Did the tutor provide (or clear) a report?
+                report = form.cleaned_data['tutor_report']
+                if 'tutor_report' in form.changed_data:
+                    part.tutor_report.delete(save=False)
+                    part.tutor_report = report or ''
+                    reports.append(part)
+
+            with transaction.atomic():
+                for grade, ids in grades.items():
+                    Participation.objects.filter(pk__in=ids).update(proposed_grade=grade)
+                for part in reports:
+                    part.save(update_fields=['tutor_report'])
             return redirect(index, permanent=True)
-        else:
-            # The supplied forms contained errors - just print them to the terminal.
-            print(form.errors for form in forms)
     else:
         # If the request was not a POST, display the forms to enter details.
-        forms = []
-        for i in range(len(participations)):
-            forms.append(ParticipationForm(instance=participations[i], prefix=str(i)))
+        forms = [ParticipationEvaluationForm(prefix=str(i), participation=part)
+                 for i, part in enumerate(participations)]
 
-    tuples = [(forms[i], participations[i]) for i in range(len(forms))]
+    tuples = [(form, form.participation) for form in forms]
 
     # Bad form (or form details), no form supplied...
     # Render rhe form with error messages (if any).
     return render(request, 'practicas/evaluate_participation.html',
-                  {'tuples': tuples, 'project': participations[0].project})
+                  {'tuples': tuples, 'project': project})
 
 
 @permission_required('practicas.student_permissions')
 def upload_report(request):
-    reg_student = get_object_or_404(RegisteredStudent, student__user=request.user, course__start__lte=date.today(),
-                                    course__end__gte=date.today())
+    reg_student = current_reg_student(request)
     practice = reg_student.practice
     participation = get_object_or_404(Participation, reg_student=reg_student)
 
@@ -245,77 +289,165 @@ def upload_report(request):
 
 @permission_required('practicas.manager_permissions')
 def assign_projects(request):
-    manager = PracticeManager.objects.get(user=request.user, practice__course__start__lte=date.today(),
-                                          practice__course__end__gte=date.today())
+    manager = current_manager(request)
     practice = manager.practice
 
-    reg_students = RegisteredStudent.objects.filter(practice=practice).order_by('group', 'student__user__last_name')
+    # One query for the students with their users and participations, one for the projects shared by every row
+    reg_students = RegisteredStudent.objects.filter(practice=practice) \
+        .select_related('student__user', 'participation').order_by('group', 'student__user__last_name')
+    projects = Project.objects.filter(practices=practice).only('id', 'name').order_by('name')
 
     # A HTTP POST?
     if request.method == 'POST':
-        forms = []
-        valid = True
-        for i in range(len(reg_students)):
-            try:
-                participation = Participation.objects.get(reg_student=reg_students[i])
-                forms.append(ParticipationAssignForm(request.POST, prefix=str(i), instance=participation))
-            except Participation.DoesNotExist:
-                forms.append(
-                    ParticipationAssignForm(request.POST, prefix=str(i), initial={'reg_student': reg_students[i]}))
-            valid = valid and forms[i].is_valid()
+        formset = ParticipationAssignFormSet(request.POST, queryset=reg_students, projects=projects)
 
         # Have been provided with valid forms?
-        if valid:
-            for i in range(len(forms)):
-                part = forms[i].save(commit=False)
-                # if not part.project_id:
-                #     print(int(forms[i].data['{0}-project'.format(i)]))
-                #     part.project = Project.objects.get(id=int(forms[i].data['{0}-project'.format(i)]))
-                part.reg_student = reg_students[i]
-                part.proposed_grade = forms[i].initial['proposed_grade']
-                part.save()
+        if formset.is_valid():
+            projects = {}
+            grades = {}
+            for form in formset:
+                if form.has_changed():
+                    projects[form.instance.pk] = form.cleaned_data['project']
+                    grades[form.instance.pk] = form.cleaned_data['grade']
+            # Save every participation, and the seats they take, at once
+            Participation.objects.bulk_assign(projects, grades)
 
             return redirect(index, permanent=True)
-        else:
-            # The supplied forms contained errors - just print them to the terminal.
-            print(form.errors for form in forms)
     else:
         # If the request was not a POST, display the forms to enter details.
-        forms = []
-        for i in range(len(reg_students)):
-            try:
-                participation = Participation.objects.get(reg_student=reg_students[i])
-                forms.append(ParticipationAssignForm(instance=participation, prefix=str(i), practice=practice))
-            except Participation.DoesNotExist:
-                forms.append(
-                    ParticipationAssignForm(prefix=str(i), practice=practice, initial={'reg_student': reg_students[i]}))
-
-        tuples = [(forms[i], reg_students[i], forms[i].instance.proposed_grade if forms[i].instance else None) for i in
-                  range(len(forms))]
+        formset = ParticipationAssignFormSet(queryset=reg_students, projects=projects)
 
-        # Bad form (or form details), no form supplied...
-        # Render rhe form with error messages (if any).
-        return render(request, 'practicas/assign_projects.html',
-                      {'tuples': tuples, 'practice': practice})
+    # Bad form (or form details), no form supplied...
+    # Render rhe form with error messages (if any).
+    return render(request, 'practicas/assign_projects.html',
+                  {'formset': formset, 'practice': practice, 'job': latest_job(practice)})
 
 
 @permission_required('practicas.manager_permissions')
 def auto_assign_projects(request):
-    manager = PracticeManager.objects.get(user=request.user, practice__course__start__lte=date.today(),
-                                          practice__course__end__gte=date.today())
-    set_participations(manager)
+    manager = current_manager(request)
+    enqueue_assignment(manager.practice)
     return redirect(assign_projects)
 
 
+@permission_required('practicas.manager_permissions')
+def auto_assign_status(request, job_id):
+    manager = current_manager(request)
+    job = get_job(job_id)
+    if not job or job.practice.id != manager.practice_id:
+        raise Http404
+    return JsonResponse(job.as_dict())
+
+
+def manager_requests(request):
+    """Requests of the current manager's practice, filtered by the query string, and the filter form."""
+    manager = current_manager(request)
+    form = RequestFilterForm(request.GET, practice=manager.practice)
+    requests = form.filter(Request.objects.filter(project__practices=manager.practice))
+    return form, requests
+
+
 class RequestsList(ListView):
     model = Request
     template_name = 'practicas/requests_list.html'
+    page_size = 100
 
     def get_queryset(self):
-        manager = PracticeManager.objects.get(user=self.request.user, practice__course__start__lte=date.today(),
-                                              practice__course__end__gte=date.today())
-        return Request.objects.filter(project__practices=manager.practice).order_by('reg_student')
+        self.filter_form, requests = manager_requests(self.request)
+        requests = requests.select_related('reg_student__student__user', 'project') \
+            .order_by('reg_student', 'priority', 'id')
+
+        # Keyset pagination: the page starts right after the (reg_student, priority, id) of the previous one
+        try:
+            reg_student, priority, pk = (int(value) for value in self.request.GET['after'].split('-'))
+            requests = requests.filter(Q(reg_student__gt=reg_student) |
+                                       Q(reg_student=reg_student, priority__gt=priority) |
+                                       Q(reg_student=reg_student, priority=priority, id__gt=pk))
+        except (KeyError, ValueError):
+            pass
+
+        page = list(requests[:self.page_size + 1])
+        self.next_page = None
+        if len(page) > self.page_size:
+            page = page[:self.page_size]
+            last = page[-1]
+            query = self.request.GET.copy()
+            query['after'] = '{0}-{1}-{2}'.format(last.reg_student_id, last.priority, last.id)
+            self.next_page = query.urlencode()
+        return page
+
+    def get_context_data(self, **kwargs):
+        context = super(RequestsList, self).get_context_data(**kwargs)
+        query = self.request.GET.copy()
+        query.pop('after', None)
+        context.update({'filter_form': self.filter_form, 'next_page': self.next_page,
+                        'is_first_page': 'after' not in self.request.GET, 'filter_query': query.urlencode()})
+        return context
 
     @method_decorator(login_required)
     def dispatch(self, request, *args, **kwargs):
         return super(RequestsList, self).dispatch(request, *args, **kwargs)
+
+
+class Echo(object):
+    """File-like object that returns what is written, so csv.writer rows can be streamed."""
+
+    def write(self, value):
+        return value
+
+
+@permission_required('practicas.manager_permissions')
+def export_requests(request):
+    _, requests = manager_requests(request)
+    rows = stream_rows(requests.order_by('reg_student', 'priority', 'id').values_list(
+        'reg_student__student__user__first_name', 'reg_student__student__user__last_name', 'reg_student__group',
+        'project__name', 'priority', 'checked'))
+    # Field converters are not applied: SQLite gives booleans as integers
+    rows = (row[:-1] + (bool(row[-1]),) for row in rows)
+
+    writer = csv.writer(Echo())
+    header = ['Nombre', 'Apellidos', 'Grupo', 'Proyecto', 'Prioridad', 'Confirmada']
+    response = StreamingHttpResponse((writer.writerow(row) for row in chain([header], rows)),
+                                     content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = 'attachment; filename="solicitudes.csv"'
+    return response
+
+
+@permission_required('practicas.manager_permissions')
+def export_participations(request):
+    """
+    Grades and participations of the manager's practice, as CSV or JSON (``?format=json``).
+    Superusers choose the ``practice`` or ``course`` to export instead, the current course by default.
+    """
+    form = ParticipationExportForm(request.GET)
+    if not form.is_valid():
+        return HttpResponse(status=400)
+    if request.user.is_superuser:
+        participations = form.filter(Participation.objects.all())
+    else:
+        participations = Participation.objects.filter(reg_student__practice=current_manager(request).practice)
+    rows = participation_rows(participations)
+
+    if form.cleaned_data['format'] == 'json':
+        response = StreamingHttpResponse(json_lines(rows), content_type='application/json; charset=utf-8')
+        response['Content-Disposition'] = 'attachment; filename="participaciones.json"'
+        return response
+
+    writer = csv.writer(Echo())
+    header = [label for _, label in PARTICIPATION_COLUMNS]
+    rows = ([('Sí' if value else 'No') if isinstance(value, bool) else value for value in row.values()]
+            for row in rows)
+    response = StreamingHttpResponse((writer.writerow(row) for row in chain([header], rows)),
+                                     content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = 'attachment; filename="participaciones.csv"'
+    return response
+
+
+@staff_member_required
+def metrics_report(request):
+    return JsonResponse(metrics.snapshot())
+
+
+@staff_member_required
+def metrics_prometheus(request):
+    return HttpResponse(metrics.prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -5,30 +5,19 @@ import django
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bd.settings')
 django.setup()
 
-from practicas.models import *
+from practicas.assignment import load_problem, solve, save_assignment, simulate
 
 
 def set_participations(manager):
-    # Set participation of students checked by tutors
-    requests = Request.objects.filter(project__practices=manager.practice, checked=True).order_by('priority')
-    for req in requests:
-        part = Participation.objects.get_or_create(reg_student=req.reg_student)[0]
-
-        if part.project:  # Skip already assigned participation
-            continue
-
-        part.project = req.project
-        part.save()
-
-    # Set other students participation
-    reg_students = RegisteredStudent.objects.filter(practice=manager.practice) \
-        .exclude(participation__project__isnull=False) \
-        .order_by('?')
-    for rs in reg_students:
-        requests = Request.objects.filter(reg_student=rs).order_by('priority')
-        for req in requests:
-            part = Participation.objects.get_or_create(reg_student=rs)[0]
-            if not part.project:
-                part.project = req.project
-                part.save()
-                break
+    # Load the whole practice once, solve the assignment in memory and write it back in one transaction.
+    # Students checked by tutors keep their project; already assigned participations are not touched.
+    problem = load_problem(manager.practice)
+    assignment = solve(problem)
+    save_assignment(problem, assignment)
+    return assignment
+
+
+def simulate_participations(manager, runs=8, processes=None):
+    # Dry run: solve several seeded variants in parallel without touching Participation
+    problem = load_problem(manager.practice)
+    return simulate(problem, range(runs), processes)